@@ -6,11 +6,14 @@ Usage:
     tcpdump -npi lo "tcp port 4949" -w munin.pcap
     # wait for one munin run, then press Ctrl-C
     ./munin-profile-node.py munin.pcap
+
+To record the sessions for the replay mode of muninnode-from-hell:
+    ./munin-profile-node.py --transcript munin.transcript munin.pcap
 """
 
 import collections
 import sys
-from scapy.utils import rdpcap
+from scapy.utils import PcapReader
 import scapy.layers.l2
 from scapy.layers.inet import IP, TCP
 
@@ -44,51 +47,150 @@ class ConnectionProfile:
         self.curcommand = None
         self.commandstart = timestamp
 
+class TranscriptWriter:
+    """
+    Writes the sessions in the transcript format of muninnode-from-hell
+    --compile-corpus. The lines of a connection are kept until it closes.
+    """
+    banner = "# munin node at "
+
+    def __init__(self, fp):
+        self.fp = fp
+        self.sessions = dict()
+
+    def handle_to_node(self, conn, timestamp, line):
+        self.sessions.setdefault(conn, []).append(
+            "> %f %s" % (timestamp, line))
+
+    def handle_from_node(self, conn, timestamp, line):
+        self.sessions.setdefault(conn, []).append(
+            "< %f %s" % (timestamp, line))
+
+    def close(self, conn):
+        lines = self.sessions.pop(conn, None)
+        if not lines:
+            return
+        # named like the banner says, or by its address
+        name = conn[2]
+        first = lines[0].split(" ", 2)
+        if first[0] == "<" and first[2].startswith(self.banner):
+            name = first[2][len(self.banner):]
+        self.fp.write("node %s\n%s\n" % (name, "\n".join(lines)))
+
+    def close_all(self):
+        for conn in list(self.sessions):
+            self.close(conn)
+
 class MuninProfiler:
-    def __init__(self):
-        self.to_node = ""
-        self.from_node = ""
+    """
+    @ivar totals: mapping of commands to the seconds waiting for answers on
+        the closed connections
+    @type totals: {str: float}
+    @ivar idle: seconds waiting for the client on the closed connections
+    @type idle: float
+    """
+    def __init__(self, transcript=None):
+        # unfinished lines to and from the node by connection
+        self.buffers = collections.defaultdict(lambda: ["", ""])
+        # directions which sent a FIN by connection
+        self.fins = collections.defaultdict(set)
         self.connprof = collections.defaultdict(ConnectionProfile)
+        self.transcript = transcript
+        self.totals = dict()
+        self.idle = 0.0
+
+    def close(self, conn):
+        """
+        Adds up the durations of a closed connection, so the memory needed
+        does not grow with the length of the capture.
+        """
+        self.buffers.pop(conn, None)
+        self.fins.pop(conn, None)
+        prof = self.connprof.pop(conn, None)
+        if prof is not None:
+            for com, durations in prof.times.items():
+                self.totals[com] = self.totals.get(com, 0.0) + sum(durations)
+            self.idle += sum(prof.idles)
+        if self.transcript:
+            self.transcript.close(conn)
 
     def handle_packet(self, packet):
-        payload = str(packet[TCP].payload)
-        if not payload:
-            return
         if packet[TCP].dport == 4949:
-            self.to_node += payload
             conn = (packet[IP].src, packet[TCP].sport, packet[IP].dst)
+            direction = 0
         elif packet[TCP].sport == 4949:
-            self.from_node += payload
             conn = (packet[IP].dst, packet[TCP].dport, packet[IP].src)
+            direction = 1
         else:
             return
-        lines = self.to_node.split("\n")
-        self.to_node = lines.pop()
-        for line in lines:
-            self.connprof[conn].handle_to_node(packet.time, line)
-        lines = self.from_node.split("\n")
-        self.from_node = lines.pop()
-        for line in lines:
-            self.connprof[conn].handle_from_node(packet.time, line)
+        payload = str(packet[TCP].payload)
+        if payload:
+            buffers = self.buffers[conn]
+            lines = (buffers[direction] + payload).split("\n")
+            buffers[direction] = lines.pop()
+            for line in lines:
+                if direction == 0:
+                    self.connprof[conn].handle_to_node(packet.time, line)
+                    if self.transcript:
+                        self.transcript.handle_to_node(conn, packet.time, line)
+                else:
+                    self.connprof[conn].handle_from_node(packet.time, line)
+                    if self.transcript:
+                        self.transcript.handle_from_node(conn, packet.time,
+                            line)
+        # after a FIN the other side may still send, so wait for both
+        if packet[TCP].flags & 0x04:
+            self.close(conn)
+        elif packet[TCP].flags & 0x01:
+            self.fins[conn].add(direction)
+            if len(self.fins[conn]) == 2:
+                self.close(conn)
 
     @property
     def times(self):
-        times = dict()
+        """
+        Unlike L{ConnectionProfile.times} the durations are summed up, as
+        keeping each of them would need memory growing with the capture.
+
+        @returns: mapping of commands to the seconds waiting for answers
+        @rtype: {str: float}
+        """
+        times = dict(self.totals)
         for prof in self.connprof.values():
             for com, durations in prof.times.items():
-                times.setdefault(com, []).extend(durations)
+                times[com] = times.get(com, 0.0) + sum(durations)
         return times
 
     @property
     def idles(self):
-        return sum((prof.idles for prof in self.connprof.values()), [])
+        """
+        Summed up like L{times}.
+
+        @returns: seconds waiting for the client
+        @rtype: float
+        """
+        return self.idle + sum(sum(prof.idles)
+                               for prof in self.connprof.values())
 
 def main():
-    mp = MuninProfiler()
-    for pkt in rdpcap(sys.argv[1]):
-        mp.handle_packet(pkt)
-    print("Client idle time during connection: %.2fs" % sum(mp.idles))
-    times = [(key, sum(value)) for key, value in mp.times.items()]
+    args = sys.argv[1:]
+    transcript = None
+    if args[:1] == ["--transcript"]:
+        transcript = TranscriptWriter(open(args[1], "w"))
+        args = args[2:]
+    mp = MuninProfiler(transcript)
+    # one packet at a time, captures may be larger than the memory
+    reader = PcapReader(args[0])
+    try:
+        for pkt in reader:
+            mp.handle_packet(pkt)
+    finally:
+        reader.close()
+    if transcript:
+        transcript.close_all()
+        transcript.fp.close()
+    print("Client idle time during connection: %.2fs" % mp.idles)
+    times = list(mp.times.items())
     times.sort(key=lambda tpl: -tpl[1])
     total = sum(value for key, value in times)
     print("Total time waiting for the node:    %.2fs" % total)
@@ -0,0 +1,531 @@
+#!/usr/bin/env python
+"""
+Benchmark and load test for pypmmn.
+
+Generates a folder of synthetic plugins, starts pypmmn on it and lets a
+number of simulated masters poll it concurrently. Each poll connects, sends
+``list`` and then ``config`` and ``fetch`` for every plugin, like munin-update
+does. The results are written as JSON, so runs of different versions or
+options can be compared.
+
+Usage::
+
+    # 8 masters polling 50 plugins which take 10ms each, 5 polls per master
+    ./pypmmn-bench.py --plugins 50 --latency 0.01 --masters 8 --rounds 5
+
+    # pass options to the node
+    ./pypmmn-bench.py --node-args="-e -w 8 --cache-ttl 60"
+
+    # inetd style: a new node process for every poll
+    ./pypmmn-bench.py --mode stdin
+
+Forks are counted system wide (from ``/proc/stat``), and the RSS is the sum
+over all processes started by the benchmark (the node, its workers and the
+plugins running at that moment). Both need Linux and are ``null`` elsewhere.
+"""
+from optparse import OptionParser
+from os.path import join, abspath, dirname
+from subprocess import Popen, PIPE
+from time import time, sleep
+import json
+import os
+import random
+import shlex
+import shutil
+import signal
+import socket
+import sys
+import tempfile
+import threading
+
+#: The node started by default
+DEFAULT_NODE = join(dirname(abspath(__file__)), '..', 'pypmmn', 'pypmmn.py')
+
+#: Seconds to wait for the node to accept connections
+STARTUP_TIMEOUT = 10
+
+#: Seconds after which a master gives up waiting for an answer
+COMMAND_TIMEOUT = 60
+
+#: Seconds between two RSS samples
+SAMPLE_INTERVAL = 0.2
+
+SHELL_PLUGIN = """#!/bin/sh
+if [ "$1" = "config" ]; then
+cat <<'EOF'
+%(config)sEOF
+exit 0
+fi
+%(sleep)scat <<'EOF'
+%(values)sEOF
+"""
+
+PYTHON_PLUGIN = """#!%(python)s
+import sys
+import time
+if sys.argv[1:] == ['config']:
+    sys.stdout.write(%(config)r)
+    sys.exit(0)
+time.sleep(%(latency)r)
+sys.stdout.write(%(values)r)
+"""
+
+
+def generate_plugins(folder, count, fields, latency, python_count, python):
+    """
+    Writes ``count`` plugins into ``folder`` and returns their names.
+
+    :param fields: The number of values of each plugin
+    :param latency: Seconds each ``fetch`` sleeps
+    :param python_count: The number of plugins written in python instead of
+        shell
+    :param python: The interpreter named in the python plugins
+    """
+    rand = random.Random(count)
+    names = []
+    for number in range(count):
+        name = 'bench_%04d' % number
+        config = ['graph_title Benchmark plugin %d' % number,
+            'graph_category bench']
+        values = []
+        for field in range(fields):
+            config.append('f%d.label field %d' % (field, field))
+            values.append('f%d.value %d' % (field, rand.randint(0, 1000000)))
+        params = {
+            'config': '\n'.join(config) + '\n',
+            'values': '\n'.join(values) + '\n',
+            'latency': latency,
+            'python': python,
+            'sleep': latency and 'sleep %s\n' % latency or '',
+            }
+        if number < python_count:
+            content = PYTHON_PLUGIN % params
+        else:
+            content = SHELL_PLUGIN % params
+        filename = join(folder, name)
+        fptr = open(filename, 'w')
+        try:
+            fptr.write(content)
+        finally:
+            fptr.close()
+        os.chmod(filename, 0755)
+        names.append(name)
+    return names
+
+
+def percentile(samples, fraction):
+    """
+    Returns the given percentile (``0.0`` to ``1.0``) of the sorted list
+    ``samples``.
+    """
+    if not samples:
+        return None
+    index = min(int(fraction * len(samples)), len(samples) - 1)
+    return samples[index]
+
+
+def summarize(samples):
+    """
+    Returns the latency summary of a list of durations in seconds.
+    """
+    samples = sorted(samples)
+    if not samples:
+        return {'count': 0}
+    return {
+        'count': len(samples),
+        'mean': round(sum(samples) / len(samples), 6),
+        'p50': round(percentile(samples, 0.5), 6),
+        'p99': round(percentile(samples, 0.99), 6),
+        'max': round(samples[-1], 6),
+        }
+
+
+def fork_count():
+    """
+    Returns the number of processes created on this system since boot, or
+    ``None`` if it cannot be determined.
+    """
+    try:
+        fptr = open('/proc/stat')
+        try:
+            for line in fptr:
+                if line.startswith('processes '):
+                    return int(line.split()[1])
+        finally:
+            fptr.close()
+    except IOError:
+        pass
+    return None
+
+
+def descendant_rss(root):
+    """
+    Returns the summed RSS (in kB) of all descendants of the process
+    ``root``, or ``None`` if ``/proc`` is not available.
+    """
+    if not os.path.isdir('/proc/self'):
+        return None
+    children = {}
+    rss = {}
+    for entry in os.listdir('/proc'):
+        if not entry.isdigit():
+            continue
+        try:
+            fptr = open('/proc/%s/status' % entry)
+            try:
+                status = fptr.read()
+            finally:
+                fptr.close()
+        except IOError:
+            # the process exited meanwhile
+            continue
+        ppid = None
+        for line in status.splitlines():
+            if line.startswith('PPid:'):
+                ppid = int(line.split()[1])
+            elif line.startswith('VmRSS:'):
+                rss[int(entry)] = int(line.split()[1])
+        children.setdefault(ppid, []).append(int(entry))
+
+    total = 0
+    pending = list(children.get(root, []))
+    while pending:
+        pid = pending.pop()
+        total += rss.get(pid, 0)
+        pending.extend(children.get(pid, []))
+    return total
+
+
+class RssSampler(object):
+    """
+    Samples the RSS of all processes started by the benchmark in a
+    background thread.
+    """
+
+    def __init__(self, interval=SAMPLE_INTERVAL):
+        self.interval = interval
+        self.samples = []
+        self._running = True
+        self._thread = threading.Thread(target=self._loop)
+        self._thread.setDaemon(True)
+
+    def _loop(self):
+        root = os.getpid()
+        while self._running:
+            rss = descendant_rss(root)
+            if rss is None:
+                return
+            self.samples.append(rss)
+            sleep(self.interval)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        """
+        Stops sampling and returns the summary.
+        """
+        self._running = False
+        self._thread.join()
+        if not self.samples:
+            return None
+        return {
+            'peak': max(self.samples),
+            'mean': sum(self.samples) // len(self.samples),
+            }
+
+
+class Master(object):
+    """
+    One simulated munin master talking to a node through ``send`` and the
+    file-like object ``reader``.
+    """
+
+    def __init__(self, send, reader):
+        self.send = send
+        self.reader = reader
+
+    def read_banner(self):
+        if not self.reader.readline():
+            raise IOError('The node closed the connection')
+
+    def command(self, line, multiline=True):
+        """
+        Sends ``line`` and reads the answer. Returns the duration in seconds.
+
+        :param multiline: ``True`` if the answer ends with a ``.`` line
+        """
+        started = time()
+        self.send(line + '\n')
+        while True:
+            answer = self.reader.readline()
+            if not answer:
+                raise IOError('The node closed the connection during %r' % (
+                    line))
+            if not multiline or answer == '.\n':
+                return time() - started
+
+    def poll(self, plugins, results):
+        """
+        Polls all ``plugins`` like munin-update and appends ``(command,
+        duration)`` tuples to ``results``.
+        """
+        self.read_banner()
+        results.append(('list', self.command('list', False)))
+        for plugin in plugins:
+            results.append(('config', self.command('config %s' % plugin)))
+            results.append(('fetch', self.command('fetch %s' % plugin)))
+        self.send('quit\n')
+
+
+class Benchmark(object):
+    """
+    Runs the simulated masters against a node and collects the numbers.
+
+    :param options: The parsed command-line options
+    :param work_dir: The folder holding the generated ``plugins`` folder.
+        The node writes its logs into it.
+    :param plugins: The plugin names
+    """
+
+    def __init__(self, options, work_dir, plugins):
+        self.options = options
+        self.work_dir = work_dir
+        self.plugin_dir = join(work_dir, 'plugins')
+        self.plugins = plugins
+        self.node_args = shlex.split(options.node_args)
+        self.results = []
+        self.errors = []
+        self._lock = threading.Lock()
+        self._log = open(join(work_dir, 'node.log'), 'w')
+
+    def node_command(self, extra):
+        return ([self.options.python, self.options.node,
+            '-d', self.plugin_dir] + extra + self.node_args)
+
+    def _record(self, results, error=None):
+        self._lock.acquire()
+        try:
+            self.results.extend(results)
+            if error is not None:
+                self.errors.append(str(error))
+        finally:
+            self._lock.release()
+
+    def _socket_master(self, port):
+        for _ in range(self.options.rounds):
+            results = []
+            error = None
+            sock = socket.create_connection(('127.0.0.1', port),
+                COMMAND_TIMEOUT)
+            try:
+                try:
+                    Master(sock.sendall, sock.makefile('rb')).poll(
+                        self.plugins, results)
+                except (IOError, socket.error), exc:
+                    error = exc
+            finally:
+                sock.close()
+            self._record(results, error)
+
+    def _stdin_master(self):
+        for _ in range(self.options.rounds):
+            results = []
+            error = None
+            # stdin mode always writes a log file
+            proc = Popen(self.node_command(['-l', self.work_dir]),
+                stdin=PIPE, stdout=PIPE,
+                stderr=self._log, close_fds=True)
+
+            def send(data):
+                proc.stdin.write(data)
+                proc.stdin.flush()
+            try:
+                Master(send, proc.stdout).poll(self.plugins, results)
+            except IOError, exc:
+                error = exc
+            proc.stdin.close()
+            proc.wait()
+            self._record(results, error)
+
+    def _wait_for_port(self, port, proc):
+        deadline = time() + STARTUP_TIMEOUT
+        while time() < deadline:
+            if proc.poll() is not None:
+                raise IOError('The node exited with status %d' % (
+                    proc.returncode))
+            try:
+                socket.create_connection(('127.0.0.1', port), 1).close()
+                return
+            except socket.error:
+                sleep(0.05)
+        raise IOError('The node did not start listening on port %d' % port)
+
+    def _run_masters(self, target, args):
+        threads = [threading.Thread(target=target, args=args)
+            for _ in range(self.options.masters)]
+        for thread in threads:
+            thread.setDaemon(True)
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+    def run(self):
+        """
+        Runs the benchmark and returns the report as dictionary.
+        """
+        node = None
+        if self.options.mode == 'socket':
+            port = self.options.port or free_port()
+            node = Popen(self.node_command(['-n', '-p', str(port)]),
+                stdout=self._log, stderr=self._log, close_fds=True)
+            try:
+                self._wait_for_port(port, node)
+            except IOError:
+                if node.poll() is None:
+                    node.kill()
+                raise
+            target, args = self._socket_master, (port, )
+        else:
+            target, args = self._stdin_master, ()
+
+        sampler = RssSampler()
+        sampler.start()
+        forks_before = fork_count()
+        started = time()
+        try:
+            self._run_masters(target, args)
+        finally:
+            duration = time() - started
+            forks_after = fork_count()
+            rss = sampler.stop()
+            if node is not None:
+                node.send_signal(signal.SIGTERM)
+                node.wait()
+            self._log.close()
+        return self.report(duration, forks_before, forks_after, rss)
+
+    def report(self, duration, forks_before, forks_after, rss):
+        durations = {}
+        for command, seconds in self.results:
+            durations.setdefault(command, []).append(seconds)
+        forks = None
+        if forks_before is not None and forks_after is not None:
+            forks = forks_after - forks_before
+        options = self.options
+        return {
+            'started': int(time() - duration),
+            'python': sys.version.split()[0],
+            'node': abspath(options.node),
+            'node_args': self.node_args,
+            'mode': options.mode,
+            'setup': {
+                'plugins': options.plugins,
+                'python_plugins': options.python_plugins,
+                'fields': options.fields,
+                'latency': options.latency,
+                'masters': options.masters,
+                'rounds': options.rounds,
+                },
+            'duration': round(duration, 3),
+            'commands': len(self.results),
+            'commands_per_second': round(len(self.results) / duration, 2),
+            'errors': len(self.errors),
+            'error_messages': sorted(set(self.errors))[:10],
+            'latency': summarize([seconds for _, seconds in self.results]),
+            'latency_by_command': dict((command, summarize(samples))
+                for command, samples in durations.items()),
+            'forks': forks,
+            'forks_per_second': forks is not None and round(
+                forks / duration, 2) or forks,
+            'rss_kb': rss,
+            }
+
+
+def free_port():
+    """
+    Returns a TCP port which is currently unused.
+    """
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    try:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+    finally:
+        sock.close()
+
+
+def get_options():
+    parser = OptionParser(usage='%prog [options]')
+    parser.add_option('--node', dest='node', default=DEFAULT_NODE,
+            help='The pypmmn.py to benchmark. Default: %default')
+    parser.add_option('--python', dest='python', default=sys.executable,
+            help='The interpreter running the node and the python plugins. '
+               'Default: %default')
+    parser.add_option('--node-args', dest='node_args', default='',
+            help='Additional command-line options of the node, for example '
+               '"-e -w 8"')
+    parser.add_option('--mode', dest='mode', default='socket',
+            type='choice', choices=['socket', 'stdin'],
+            help='"socket" starts one node listening on a port. "stdin" '
+               'starts a new node for every poll. Default: %default')
+    parser.add_option('--port', dest='port', default=0, type='int',
+            help='The port of the node in socket mode. Default: a free one')
+    parser.add_option('--plugins', dest='plugins', default=20, type='int',
+            help='The number of generated plugins. Default: %default')
+    parser.add_option('--python-plugins', dest='python_plugins', default=0,
+            type='int',
+            help='How many of them are python scripts instead of shell '
+               'scripts. Default: %default')
+    parser.add_option('--fields', dest='fields', default=10, type='int',
+            help='The number of values of each plugin. Default: %default')
+    parser.add_option('--latency', dest='latency', default=0, type='float',
+            help='Seconds each fetch of a plugin takes. Default: %default')
+    parser.add_option('--masters', dest='masters', default=4, type='int',
+            help='The number of concurrently polling masters. '
+               'Default: %default')
+    parser.add_option('--rounds', dest='rounds', default=5, type='int',
+            help='The number of polls of each master. Default: %default')
+    parser.add_option('-o', '--output', dest='output',
+            help='Write the JSON report into this file instead of stdout')
+    parser.add_option('--keep', dest='keep', default=False,
+            action='store_true',
+            help='Keep the generated plugins and the node log')
+    options, args = parser.parse_args()
+    if args:
+        parser.error('No arguments expected')
+    if options.masters < 1 or options.rounds < 1 or options.plugins < 1:
+        parser.error('--plugins, --masters and --rounds must be positive')
+    return options
+
+
+def main():
+    options = get_options()
+    work_dir = tempfile.mkdtemp(prefix='pypmmn-bench-')
+    plugin_dir = join(work_dir, 'plugins')
+    os.mkdir(plugin_dir)
+    try:
+        plugins = generate_plugins(plugin_dir, options.plugins,
+            options.fields, options.latency, options.python_plugins,
+            options.python)
+        report = Benchmark(options, work_dir, plugins).run()
+    finally:
+        if options.keep:
+            sys.stderr.write('Plugins and node log kept in %s\n' % work_dir)
+        else:
+            shutil.rmtree(work_dir, True)
+
+    output = json.dumps(report, indent=2, sort_keys=True) + '\n'
+    if options.output:
+        fptr = open(options.output, 'w')
+        try:
+            fptr.write(output)
+        finally:
+            fptr.close()
+    else:
+        sys.stdout.write(output)
+    if report['errors']:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,209 @@
+"""
+Asynchronous logging.
+
+Writing a log record (and checking whether the log file needs to be
+rotated) happens in the thread emitting it. On a busy node, this adds to the
+latency of every command. :py:class:`AsyncHandler` only queues the records.
+A background thread formats them and passes them to the real handlers.
+
+Records are formatted in the background thread, so arguments passed to the
+logging calls must not be modified afterwards. Tracebacks are formatted right
+away, as the frames may change.
+
+The emitting thread still takes the locks of the logging module and of the
+handler, but holds them only as long as it takes to queue the record.
+"""
+from collections import deque
+import logging
+import random
+import threading
+
+#: The maximum number of queued records. Further records are dropped.
+QUEUE_SIZE = 10000
+
+# all handlers, to restart them after a fork
+_handlers = []
+
+_formatter = logging.Formatter()
+
+
+class DebugSampler(logging.Filter):
+    """
+    Passes only a random sample of the debug records.
+
+    :param rate: The fraction of debug records to pass, between ``0`` and
+        ``1``
+    """
+
+    def __init__(self, rate):
+        logging.Filter.__init__(self)
+        self.rate = rate
+
+    def filter(self, record):
+        if record.levelno > logging.DEBUG:
+            return True
+        return random.random() < self.rate
+
+
+class AsyncHandler(logging.Handler):
+    """
+    Queues records for a background thread, which passes them to
+    ``targets``.
+
+    :param targets: The handlers writing the records
+    :param queue_size: The maximum number of queued records. If the queue is
+        full, records are dropped and counted in ``dropped``.
+    """
+
+    def __init__(self, targets, queue_size=QUEUE_SIZE):
+        logging.Handler.__init__(self)
+        self.targets = targets
+        self.queue_size = queue_size
+        self.dropped = 0
+        self._reported = 0
+        self._queue = deque()
+        # guards the queue and signals new records and finished writes
+        self._cond = threading.Condition()
+        self._writing = False
+        self._stopped = False
+        self._start()
+        _handlers.append(self)
+
+    def _start(self):
+        self._thread = threading.Thread(target=self._drain,
+            name='log-writer')
+        self._thread.setDaemon(True)
+        self._thread.start()
+
+    def emit(self, record):
+        if record.exc_info:
+            if not record.exc_text:
+                record.exc_text = _formatter.formatException(record.exc_info)
+            record.exc_info = None
+        self._cond.acquire()
+        try:
+            if len(self._queue) >= self.queue_size:
+                self.dropped += 1
+            else:
+                self._queue.append(record)
+            self._cond.notifyAll()
+        finally:
+            self._cond.release()
+
+    def _write(self, record):
+        for target in self.targets:
+            if record.levelno >= target.level:
+                target.handle(record)
+
+    def _pending(self):
+        return self._queue or self.dropped != self._reported
+
+    def _write_pending(self):
+        # the records are written without holding the lock, so emitting
+        # threads never wait for the targets
+        self._cond.acquire()
+        try:
+            records = list(self._queue)
+            self._queue.clear()
+            dropped = self.dropped - self._reported
+            self._reported = self.dropped
+            self._writing = True
+        finally:
+            self._cond.release()
+        try:
+            for record in records:
+                self._write(record)
+            if dropped:
+                self._write(logging.makeLogRecord({
+                    'name': __name__,
+                    'levelno': logging.WARNING,
+                    'levelname': 'WARNING',
+                    'msg': '%d log messages dropped, the log queue was full',
+                    'args': (dropped, ),
+                    }))
+        finally:
+            self._cond.acquire()
+            try:
+                self._writing = False
+                self._cond.notifyAll()
+            finally:
+                self._cond.release()
+
+    def _drain(self):
+        while True:
+            self._cond.acquire()
+            try:
+                while not self._pending() and not self._stopped:
+                    self._cond.wait()
+                if self._stopped:
+                    return
+            finally:
+                self._cond.release()
+            try:
+                self._write_pending()
+            except Exception:
+                # the targets report their own errors, this must not stop
+                pass
+
+    def reinit_after_fork(self):
+        """
+        Replaces the locks and the thread, which did not survive a
+        ``fork()``. Records queued before the fork are written by the parent
+        and dropped here.
+        """
+        self._queue.clear()
+        self._cond = threading.Condition()
+        self.createLock()
+        for target in self.targets:
+            target.createLock()
+        self._writing = False
+        self._start()
+
+    def flush(self):
+        """
+        Waits until all queued records are written.
+        """
+        if self._thread.isAlive():
+            self._cond.acquire()
+            try:
+                while self._pending() or self._writing:
+                    self._cond.wait()
+            finally:
+                self._cond.release()
+        for target in self.targets:
+            target.flush()
+
+    def close(self):
+        """
+        Writes the queued records and stops the thread.
+        """
+        self._cond.acquire()
+        try:
+            self._stopped = True
+            self._cond.notifyAll()
+        finally:
+            self._cond.release()
+        if self._thread.isAlive():
+            self._thread.join()
+        self._write_pending()
+        for target in self.targets:
+            target.close()
+        logging.Handler.close(self)
+
+
+def flush_all():
+    """
+    Writes the queued records of all asynchronous handlers. Must be called
+    before leaving with ``os._exit()``.
+    """
+    for handler in _handlers:
+        handler.flush()
+
+
+def reinit_after_fork():
+    """
+    Restarts all asynchronous handlers. Must be called in the child process
+    after a ``fork()``.
+    """
+    for handler in _handlers:
+        handler.reinit_after_fork()
@@ -0,0 +1,146 @@
+"""
+An in-memory cache for plugin output, shared by all sessions of a node.
+"""
+from time import time
+import logging
+import threading
+
+LOG = logging.getLogger(__name__)
+
+
+class _Entry(object):
+    """
+    A cached plugin result. Entries form a doubly linked list ordered from
+    least to most recently used.
+    """
+    __slots__ = ('key', 'output', 'expires', 'mtime', 'prev', 'next')
+
+    def __init__(self, key, output, expires, mtime):
+        self.key = key
+        self.output = output
+        self.expires = expires
+        self.mtime = mtime
+        self.prev = None
+        self.next = None
+
+
+class ResultCache(object):
+    """
+    Caches plugin output keyed by ``(plugin, command)``.
+
+    Entries expire after a per-plugin TTL. When more than ``max_entries``
+    results are stored, the least recently used entry is evicted. ``config``
+    entries are additionally dropped as soon as the modification time of the
+    plugin file changes.
+
+    :param default_ttl: TTL in seconds for plugins without a specific TTL
+    :param ttls: A dictionary mapping plugin names to TTLs in seconds. A TTL
+        of ``0`` disables caching for that plugin.
+    :param max_entries: The maximum number of cached results
+    """
+
+    def __init__(self, default_ttl, ttls=None, max_entries=1024):
+        self.default_ttl = default_ttl
+        self.ttls = ttls or {}
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = {}
+        self._lock = threading.Lock()
+        # sentinel of the LRU list. head.next is the oldest entry.
+        self._head = _Entry(None, None, 0, None)
+        self._head.prev = self._head.next = self._head
+
+    def ttl(self, plugin):
+        """
+        Returns the TTL in seconds for ``plugin``.
+        """
+        return self.ttls.get(plugin, self.default_ttl)
+
+    def _unlink(self, entry):
+        entry.prev.next = entry.next
+        entry.next.prev = entry.prev
+
+    def _append(self, entry):
+        last = self._head.prev
+        last.next = entry
+        entry.prev = last
+        entry.next = self._head
+        self._head.prev = entry
+
+    def _is_valid(self, entry, mtime):
+        if entry.expires < time():
+            return False
+        if entry.key[1] == 'config' and entry.mtime != mtime:
+            return False
+        return True
+
+    def get(self, plugin, cmd, mtime=None):
+        """
+        Returns the cached output or ``None``.
+
+        :param plugin: The plugin name
+        :param cmd: The munin command
+        :param mtime: The current modification time of the plugin file. Used
+            to invalidate ``config`` entries.
+        """
+        key = (plugin, cmd)
+        self._lock.acquire()
+        try:
+            entry = self._entries.get(key)
+            if entry is not None and not self._is_valid(entry, mtime):
+                self._unlink(entry)
+                del self._entries[key]
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._unlink(entry)
+            self._append(entry)
+            return entry.output
+        finally:
+            self._lock.release()
+
+    def has(self, plugin, cmd, mtime=None):
+        """
+        Returns ``True`` if a valid entry exists. Does not touch the hit/miss
+        counters or the LRU order.
+        """
+        self._lock.acquire()
+        try:
+            entry = self._entries.get((plugin, cmd))
+            return entry is not None and self._is_valid(entry, mtime)
+        finally:
+            self._lock.release()
+
+    def put(self, plugin, cmd, output, mtime=None, ttl=None):
+        """
+        Stores the output of a plugin run.
+
+        :param ttl: Overrides the TTL of the plugin for this entry
+        """
+        if ttl is None:
+            ttl = self.ttl(plugin)
+        if ttl <= 0 or self.max_entries <= 0:
+            return
+        key = (plugin, cmd)
+        entry = _Entry(key, output, time() + ttl, mtime)
+        self._lock.acquire()
+        try:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self._unlink(old)
+            self._entries[key] = entry
+            self._append(entry)
+            while len(self._entries) > self.max_entries:
+                oldest = self._head.next
+                self._unlink(oldest)
+                del self._entries[oldest.key]
+                self.evictions += 1
+        finally:
+            self._lock.release()
+
+    def __len__(self):
+        return len(self._entries)
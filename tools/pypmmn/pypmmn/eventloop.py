@@ -0,0 +1,509 @@
+"""
+A small, dependency-free event loop used to serve many munin sessions from a
+single process.
+
+The loop multiplexes sockets using ``poll`` (or ``select`` where ``poll`` is
+not available), keeps a heap of timers for per-session deadlines and offers a
+thread-safe way to hand work back into the loop. Plugin commands are blocking
+by nature, so each command runs in a helper thread and writes its output back
+through the loop.
+"""
+from errno import EAGAIN, EWOULDBLOCK, EINTR, ECONNRESET, EPIPE
+from heapq import heappush, heappop
+from time import time
+import fcntl
+import logging
+import os
+import select
+import socket
+import threading
+
+from protocol import LineBuffer, LineTooLong
+
+LOG = logging.getLogger(__name__)
+
+#: Read-size used for incoming session data
+RECV_SIZE = 4096
+
+#: Command threads wait while a session has more unsent bytes than this
+MAX_UNSENT = 256 * 1024
+
+
+def set_nonblocking(fd):
+    """
+    Puts the file descriptor ``fd`` into non-blocking mode.
+    """
+    flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+    fcntl.fcntl(fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+
+
+class Timer(object):
+    """
+    A handle to a callback scheduled with :py:meth:`EventLoop.call_later`.
+    """
+
+    def __init__(self, when, callback, args):
+        self.when = when
+        self.callback = callback
+        self.args = args
+        self.cancelled = False
+
+    def cancel(self):
+        """
+        Prevents the callback from running. Cancelled timers are dropped
+        lazily when they reach the top of the heap.
+        """
+        self.cancelled = True
+
+
+class EventLoop(object):
+    """
+    A minimal reactor: file descriptor callbacks, timers and a thread-safe
+    callback queue.
+    """
+
+    def __init__(self):
+        self._readers = {}
+        self._writers = {}
+        self._timers = []
+        self._timer_seq = 0
+        self._pending = []
+        self._lock = threading.Lock()
+        self._running = False
+        if hasattr(select, 'poll'):
+            self._poller = select.poll()
+        else:
+            self._poller = None
+
+        # self-pipe used to wake up the loop from other threads
+        self._wake_r, self._wake_w = os.pipe()
+        set_nonblocking(self._wake_r)
+        set_nonblocking(self._wake_w)
+        self.add_reader(self._wake_r, self._drain_wakeup)
+
+    def _update(self, fd):
+        if self._poller is None:
+            return
+        mask = 0
+        if fd in self._readers:
+            mask |= select.POLLIN | select.POLLPRI
+        if fd in self._writers:
+            mask |= select.POLLOUT
+        if mask:
+            self._poller.register(fd, mask)
+        else:
+            try:
+                self._poller.unregister(fd)
+            except KeyError:
+                pass
+
+    def add_reader(self, fd, callback):
+        """
+        Calls ``callback()`` whenever ``fd`` becomes readable.
+        """
+        self._readers[fd] = callback
+        self._update(fd)
+
+    def remove_reader(self, fd):
+        """
+        Stops watching ``fd`` for readability.
+        """
+        self._readers.pop(fd, None)
+        self._update(fd)
+
+    def add_writer(self, fd, callback):
+        """
+        Calls ``callback()`` whenever ``fd`` becomes writable.
+        """
+        self._writers[fd] = callback
+        self._update(fd)
+
+    def remove_writer(self, fd):
+        """
+        Stops watching ``fd`` for writability.
+        """
+        self._writers.pop(fd, None)
+        self._update(fd)
+
+    def call_later(self, delay, callback, *args):
+        """
+        Runs ``callback(*args)`` after ``delay`` seconds. Returns a
+        :py:class:`Timer` which may be cancelled.
+
+        This method must only be called from the loop thread.
+        """
+        timer = Timer(time() + delay, callback, args)
+        self._timer_seq += 1
+        heappush(self._timers, (timer.when, self._timer_seq, timer))
+        return timer
+
+    def call_soon_threadsafe(self, callback, *args):
+        """
+        Schedules ``callback(*args)`` to run in the loop thread. This is the
+        only method which may be called from other threads.
+        """
+        self._lock.acquire()
+        try:
+            self._pending.append((callback, args))
+        finally:
+            self._lock.release()
+        try:
+            os.write(self._wake_w, 'x')
+        except OSError, exc:
+            if exc.errno not in (EAGAIN, EWOULDBLOCK):
+                raise
+
+    def _drain_wakeup(self):
+        try:
+            while os.read(self._wake_r, 4096):
+                pass
+        except OSError, exc:
+            if exc.errno not in (EAGAIN, EWOULDBLOCK):
+                raise
+
+    def stop(self):
+        """
+        Makes :py:meth:`run_forever` return after the current iteration.
+        """
+        self._running = False
+
+    def _next_timeout(self):
+        while self._timers and self._timers[0][2].cancelled:
+            heappop(self._timers)
+        if self._pending:
+            return 0
+        if not self._timers:
+            return None
+        return max(0, self._timers[0][0] - time())
+
+    def _wait(self, timeout):
+        if self._poller is not None:
+            if timeout is not None:
+                timeout = timeout * 1000
+            try:
+                events = self._poller.poll(timeout)
+            except select.error, exc:
+                if exc.args[0] == EINTR:
+                    return [], []
+                raise
+            readable = []
+            writable = []
+            for fd, mask in events:
+                if mask & (select.POLLIN | select.POLLPRI | select.POLLHUP |
+                        select.POLLERR | select.POLLNVAL):
+                    readable.append(fd)
+                if mask & select.POLLOUT:
+                    writable.append(fd)
+            return readable, writable
+        try:
+            readable, writable, _ = select.select(
+                self._readers.keys(), self._writers.keys(), [], timeout)
+        except select.error, exc:
+            if exc.args[0] == EINTR:
+                return [], []
+            raise
+        return readable, writable
+
+    def run_once(self):
+        """
+        Waits for I/O or timers once and dispatches all ready callbacks.
+        """
+        readable, writable = self._wait(self._next_timeout())
+
+        for fd in readable:
+            callback = self._readers.get(fd)
+            if callback is None and fd not in self._writers:
+                # hangup on a descriptor nobody is interested in anymore
+                self._update(fd)
+            elif callback is not None:
+                callback()
+        for fd in writable:
+            callback = self._writers.get(fd)
+            if callback is not None:
+                callback()
+
+        now = time()
+        while self._timers and self._timers[0][0] <= now:
+            timer = heappop(self._timers)[2]
+            if not timer.cancelled:
+                timer.callback(*timer.args)
+
+        self._lock.acquire()
+        try:
+            pending = self._pending
+            self._pending = []
+        finally:
+            self._lock.release()
+        for callback, args in pending:
+            callback(*args)
+
+    def run_forever(self):
+        """
+        Runs the loop until :py:meth:`stop` is called.
+        """
+        self._running = True
+        while self._running:
+            self.run_once()
+
+
+class Session(object):
+    """
+    One connected munin master.
+
+    Input is split into lines which are queued and executed one after the
+    other in a helper thread, so a slow plugin only ever stalls its own
+    session. Output produced by the handler is marshalled back into the loop
+    and written as the socket accepts it. The helper thread waits while more
+    than :py:data:`MAX_UNSENT` bytes are not sent yet, so a slow master slows
+    down the plugin instead of filling the memory.
+
+    :param loop: The :py:class:`EventLoop` serving this session
+    :param conn: The connected socket
+    :param addr: The peer address
+    :param handler_factory: Callable taking a ``put_fun`` and returning a new
+        command handler.
+    :param timeout: Idle seconds after which the session is closed
+    :param on_close: Called with the session once it is closed
+    """
+
+    def __init__(self, loop, conn, addr, handler_factory, timeout,
+            on_close=None):
+        self.loop = loop
+        self.conn = conn
+        self.addr = addr
+        self.fd = conn.fileno()
+        self.timeout = timeout
+        self.on_close = on_close
+        self.handler = handler_factory(self.write_threadsafe)
+        self.closed = False
+        self.closing = False
+        self.busy = False
+        self._reader = LineBuffer()
+        self._lines = []
+        self._outbuf = []
+        self._unsent = 0
+        self._unsent_cond = threading.Condition()
+        self._idle_timer = None
+
+        conn.setblocking(0)
+        self.loop.add_reader(self.fd, self._on_readable)
+        self._touch()
+
+    def start(self):
+        """
+        Sends the greeting banner.
+        """
+        self.handler.do_version(None)
+        self.handler.start_session(self.addr[0])
+
+    def _touch(self):
+        if self._idle_timer is not None:
+            self._idle_timer.cancel()
+        self._idle_timer = self.loop.call_later(self.timeout, self._on_idle)
+
+    def _on_idle(self):
+        self._idle_timer = None
+        if self.closed:
+            return
+        if self.busy:
+            # a command is still running. Check again later.
+            self._touch()
+            return
+        LOG.info('Session timeout for %s.', self.addr)
+        self.close()
+
+    def _on_readable(self):
+        try:
+            data = self.conn.recv(RECV_SIZE)
+        except socket.error, exc:
+            if exc.args[0] in (EAGAIN, EWOULDBLOCK, EINTR):
+                return
+            LOG.warning('Socket error on %s: %s', self.addr, exc)
+            self.close()
+            return
+        if not data:
+            LOG.info('Connection closed by %s.', self.addr)
+            self.close()
+            return
+        self._touch()
+        try:
+            self._lines.extend(self._reader.feed(data))
+        except LineTooLong, exc:
+            LOG.warning('Closing connection to %s: %s', self.addr, exc)
+            self.write('# %s\n' % exc)
+            self.closing = True
+            self._maybe_finish()
+            return
+        if len(self._lines) > 1:
+            # a pipelined batch. Start all plugins at once.
+            self.handler.speculate_lines(self._lines)
+        self._dispatch()
+
+    def _dispatch(self):
+        while self._lines and not self.busy and not self.closing:
+            line = self._lines.pop(0).strip()
+            if not line:
+                continue
+            if line.split(' ')[0] in ('quit', 'exit'):
+                LOG.info('Client %s requested session end.', self.addr)
+                self.closing = True
+                self._maybe_finish()
+                return
+            self.busy = True
+            worker = threading.Thread(target=self._run_command, args=(line,))
+            worker.setDaemon(True)
+            worker.start()
+
+    def _run_command(self, line):
+        """
+        Executed in a helper thread.
+        """
+        try:
+            try:
+                self.handler.handle_input(line)
+            except SystemExit:
+                self.loop.call_soon_threadsafe(self._request_close)
+            except Exception:
+                LOG.exception('Error while handling %r', line)
+        finally:
+            self.loop.call_soon_threadsafe(self._command_done)
+
+    def _request_close(self):
+        self.closing = True
+
+    def _command_done(self):
+        self.busy = False
+        self._touch()
+        if self.closing:
+            self._maybe_finish()
+        else:
+            self._dispatch()
+
+    def _add_unsent(self, size):
+        self._unsent_cond.acquire()
+        try:
+            self._unsent += size
+            if size < 0:
+                self._unsent_cond.notifyAll()
+        finally:
+            self._unsent_cond.release()
+
+    def write_threadsafe(self, data):
+        """
+        ``put_fun`` for the command handler. May be called from any thread.
+        Blocks while too much data is waiting to be sent, which only happens
+        in the helper threads: the loop thread just sends the banner.
+        """
+        if not data:
+            return
+        self._unsent_cond.acquire()
+        try:
+            while self._unsent >= MAX_UNSENT and not self.closed:
+                self._unsent_cond.wait(1)
+            self._unsent += len(data)
+        finally:
+            self._unsent_cond.release()
+        self.loop.call_soon_threadsafe(self._append, data)
+
+    def write(self, data):
+        """
+        Queues ``data`` for sending. Must be called from the loop thread.
+        """
+        if not data:
+            return
+        self._add_unsent(len(data))
+        self._append(data)
+
+    def _append(self, data):
+        if self.closed:
+            return
+        self._outbuf.append(data)
+        self._on_writable()
+
+    def _on_writable(self):
+        while self._outbuf:
+            chunk = self._outbuf[0]
+            try:
+                sent = self.conn.send(chunk)
+            except socket.error, exc:
+                if exc.args[0] in (EAGAIN, EWOULDBLOCK, EINTR):
+                    break
+                if exc.args[0] not in (ECONNRESET, EPIPE):
+                    LOG.warning('Socket error on %s: %s', self.addr, exc)
+                self.close()
+                return
+            self._add_unsent(-sent)
+            if sent < len(chunk):
+                self._outbuf[0] = chunk[sent:]
+                break
+            self._outbuf.pop(0)
+
+        if self._outbuf:
+            self.loop.add_writer(self.fd, self._on_writable)
+        else:
+            self.loop.remove_writer(self.fd)
+            self._maybe_finish()
+
+    def _maybe_finish(self):
+        if self.closing and not self.busy and not self._outbuf:
+            self.close()
+
+    def close(self):
+        """
+        Closes the connection and releases all loop resources.
+        """
+        if self.closed:
+            return
+        self.closed = True
+        self._add_unsent(-self._unsent)
+        if self._idle_timer is not None:
+            self._idle_timer.cancel()
+            self._idle_timer = None
+        self.loop.remove_reader(self.fd)
+        self.loop.remove_writer(self.fd)
+        try:
+            self.conn.shutdown(socket.SHUT_RDWR)
+        except socket.error:
+            pass
+        self.conn.close()
+        self.handler.end_session()
+        if self.on_close:
+            self.on_close(self)
+
+
+class Server(object):
+    """
+    Accepts connections on ``listener`` and creates a :py:class:`Session` for
+    each of them.
+
+    :param loop: The :py:class:`EventLoop` to run in
+    :param listener: A bound and listening socket
+    :param handler_factory: See :py:class:`Session`
+    :param timeout: Idle timeout for sessions in seconds
+    """
+
+    def __init__(self, loop, listener, handler_factory, timeout):
+        self.loop = loop
+        self.listener = listener
+        self.handler_factory = handler_factory
+        self.timeout = timeout
+        self.sessions = {}
+        listener.setblocking(0)
+        self.loop.add_reader(listener.fileno(), self._on_accept)
+
+    def _on_accept(self):
+        while True:
+            try:
+                conn, addr = self.listener.accept()
+            except socket.error, exc:
+                if exc.args[0] not in (EAGAIN, EWOULDBLOCK, EINTR):
+                    LOG.warning('Unable to accept connection: %s', exc)
+                return
+            LOG.info('Accepting incoming connection from %s', addr)
+            session = Session(self.loop, conn, addr, self.handler_factory,
+                self.timeout, self._on_session_closed)
+            self.sessions[session.fd] = session
+            session.start()
+
+    def _on_session_closed(self, session):
+        self.sessions.pop(session.fd, None)
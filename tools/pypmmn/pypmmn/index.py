@@ -0,0 +1,195 @@
+"""
+An in-memory index of the plugin folder.
+
+Listing the plugin folder and checking every plugin on each command costs a
+lot of system calls on nodes with many (symlinked) plugins. The index scans
+the folder once and only rescans it when it changed. Changes are detected
+with inotify where available, and by the modification time of the folder
+otherwise. As a safety net (for example for permission changes of symlink
+targets, which change neither), the folder is rescanned after
+:py:data:`MAX_AGE` seconds in any case.
+"""
+from errno import EAGAIN, EINTR
+from os import listdir, access, stat, X_OK
+from os.path import join, isdir
+from time import time
+import logging
+import os
+import threading
+
+LOG = logging.getLogger(__name__)
+
+#: Rescan the folder after this many seconds even if no change was detected
+MAX_AGE = 300
+
+try:
+    import ctypes
+    import ctypes.util
+    _libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6',
+        use_errno=True)
+    _inotify_init1 = _libc.inotify_init1
+    _inotify_add_watch = _libc.inotify_add_watch
+    _inotify_add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p,
+        ctypes.c_uint32]
+except (ImportError, OSError, AttributeError, TypeError):
+    _inotify_init1 = None
+
+# constants from <sys/inotify.h>
+IN_NONBLOCK = os.O_NONBLOCK
+IN_CLOEXEC = 0x80000  # O_CLOEXEC
+IN_ATTRIB = 0x00000004
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+WATCH_MASK = (IN_ATTRIB | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE |
+    IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF)
+
+
+class DirectoryWatch(object):
+    """
+    Reports changes of a folder using inotify. Use :py:func:`create_watch`
+    to get an instance, as inotify is not available everywhere.
+    """
+
+    def __init__(self, fd):
+        self.fd = fd
+
+    def changed(self):
+        """
+        Returns ``True`` if the folder changed since the last call. Never
+        blocks.
+        """
+        changed = False
+        while True:
+            try:
+                data = os.read(self.fd, 4096)
+            except OSError, exc:
+                if exc.errno == EINTR:
+                    continue
+                if exc.errno == EAGAIN:
+                    return changed
+                raise
+            if not data:
+                return changed
+            changed = True
+
+    def close(self):
+        """
+        Releases the inotify descriptor.
+        """
+        os.close(self.fd)
+
+
+def create_watch(path):
+    """
+    Returns a :py:class:`DirectoryWatch` for ``path``, or ``None`` if
+    inotify is not available.
+    """
+    if _inotify_init1 is None:
+        return None
+    fd = _inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+    if fd < 0:
+        return None
+    if _inotify_add_watch(fd, path, WATCH_MASK) < 0:
+        os.close(fd)
+        return None
+    return DirectoryWatch(fd)
+
+
+class PluginIndex(object):
+    """
+    The executable plugins of ``plugin_dir`` with their full paths.
+
+    Symlinks are deliberately not resolved, as wildcard plugins derive
+    their configuration from the name they are called by.
+
+    :param plugin_dir: The plugin folder
+    :param max_age: Rescan after this many seconds in any case
+    :param use_inotify: Whether to try inotify for change detection
+    """
+
+    def __init__(self, plugin_dir, max_age=MAX_AGE, use_inotify=True):
+        self.plugin_dir = plugin_dir
+        self.max_age = max_age
+        self.scans = 0
+        self._plugins = None
+        self._names = []
+        self._mtime = None
+        self._scanned_at = 0
+        self._lock = threading.Lock()
+        self._watch = None
+        if use_inotify:
+            try:
+                self._watch = create_watch(plugin_dir)
+            except OSError, exc:
+                LOG.warning('Unable to watch %s: %s', plugin_dir, exc)
+        if self._watch is not None:
+            LOG.info('Watching %s using inotify', plugin_dir)
+
+    def _scan(self):
+        LOG.debug('Scanning plugins inside %s', self.plugin_dir)
+        mtime = stat(self.plugin_dir).st_mtime
+        plugins = {}
+        names = []
+        for filename in sorted(listdir(self.plugin_dir)):
+            path = join(self.plugin_dir, filename)
+            if isdir(path):
+                continue
+            if not access(path, X_OK):
+                LOG.warning('Non-executable plugin %s found!', filename)
+                continue
+            LOG.debug('Found plugin: %s', filename)
+            plugins[filename] = path
+            names.append(filename)
+        self._plugins = plugins
+        self._names = names
+        self._mtime = mtime
+        self._scanned_at = time()
+        self.scans += 1
+
+    def _is_stale(self):
+        if self._plugins is None:
+            return True
+        if time() - self._scanned_at > self.max_age:
+            return True
+        if self._watch is not None:
+            return self._watch.changed()
+        return stat(self.plugin_dir).st_mtime != self._mtime
+
+    def refresh(self):
+        """
+        Rescans the folder if it changed.
+
+        :raises OSError: if the folder cannot be read
+        """
+        self._lock.acquire()
+        try:
+            if self._is_stale():
+                self._scan()
+        finally:
+            self._lock.release()
+
+    def names(self):
+        """
+        Returns the names of all executable plugins.
+
+        :raises OSError: if the folder cannot be read
+        """
+        self.refresh()
+        return list(self._names)
+
+    def lookup(self, plugin):
+        """
+        Returns the full path of ``plugin``, or ``None`` if there is no
+        such executable plugin.
+        """
+        try:
+            self.refresh()
+        except OSError, exc:
+            LOG.warning('Unable to read %s: %s', self.plugin_dir, exc)
+        if self._plugins is None:
+            return None
+        return self._plugins.get(plugin)
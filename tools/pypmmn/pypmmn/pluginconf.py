@@ -0,0 +1,318 @@
+"""
+Support for munin's ``plugin-conf.d`` configuration format::
+
+    [*]
+    env.lang C
+
+    [if_*]
+    user root
+
+    [znc_logs]
+    group adm, (mail)
+    env.logdir /var/lib/znc/logs
+    timeout 30
+
+Sections apply to the plugins matching their name, which may contain shell
+style wildcards. Like in munin-node, wildcard sections are applied from the
+shortest to the longest pattern, and a section naming the plugin exactly
+overrides them all. Groups in parentheses are optional and skipped if they
+do not exist.
+
+The settings of each plugin are compiled once into a
+:py:class:`PluginConfig` holding the complete environment and the numeric
+credentials, and cached until one of the configuration files changes.
+"""
+from fnmatch import fnmatch
+from os import listdir, stat
+from os.path import join, isfile
+from time import time
+import grp
+import logging
+import os
+import pwd
+import threading
+
+LOG = logging.getLogger(__name__)
+
+#: Files with these suffixes are backups or editor files and are skipped
+IGNORED_SUFFIXES = ('~', '.bak', '.old', '.orig', '.rej', '.swp', '.tmp',
+    '.rpmnew', '.rpmsave', '.dpkg-old', '.dpkg-new', '.dpkg-dist',
+    '.dpkg-bak', '.dpkg-tmp')
+
+#: Seconds between two checks of the configuration files for changes
+CHECK_INTERVAL = 2
+
+
+class Section(object):
+    """
+    One ``[name]`` section of a configuration file.
+    """
+
+    def __init__(self, pattern, order):
+        self.pattern = pattern
+        self.order = order
+        self.env = {}
+        self.settings = {}
+
+    def is_wildcard(self):
+        return '*' in self.pattern or '?' in self.pattern or (
+            '[' in self.pattern)
+
+    def matches(self, plugin):
+        if self.is_wildcard():
+            return fnmatch(plugin, self.pattern)
+        return plugin == self.pattern
+
+
+def parse(lines, filename='<config>', first_order=0):
+    """
+    Parses the lines of one configuration file into a list of
+    :py:class:`Section` instances. Invalid lines are logged and skipped.
+
+    :param first_order: The sequence number of the first section. Later
+        sections win over earlier ones of the same rank.
+    """
+    sections = []
+    section = None
+    for number, line in enumerate(lines):
+        line = line.strip()
+        if not line or line.startswith('#'):
+            continue
+        if line.startswith('[') and line.endswith(']'):
+            section = Section(line[1:-1].strip(),
+                first_order + len(sections))
+            sections.append(section)
+            continue
+        if section is None:
+            LOG.warning('%s:%d: Setting outside of a section', filename,
+                number + 1)
+            continue
+        parts = line.split(None, 1)
+        key = parts[0]
+        value = len(parts) > 1 and parts[1].strip() or ''
+        if key.startswith('env.'):
+            section.env[key[4:]] = value
+        elif key in ('user', 'group', 'timeout'):
+            section.settings[key] = value
+        else:
+            LOG.debug('%s:%d: Ignoring setting %r', filename, number + 1,
+                key)
+    return sections
+
+
+def is_config_file(filename):
+    """
+    Returns ``True`` unless ``filename`` is a hidden, backup or editor file.
+    """
+    if filename.startswith('.') or filename.startswith('#'):
+        return False
+    return not filename.endswith(IGNORED_SUFFIXES)
+
+
+def parse_folder(conf_dir):
+    """
+    Parses all configuration files inside ``conf_dir`` in alphabetical
+    order.
+    """
+    sections = []
+    for filename in sorted(listdir(conf_dir)):
+        path = join(conf_dir, filename)
+        if not is_config_file(filename) or not isfile(path):
+            continue
+        try:
+            fptr = open(path)
+            try:
+                sections.extend(parse(fptr, path, len(sections)))
+            finally:
+                fptr.close()
+        except IOError, exc:
+            LOG.warning('Unable to read %s: %s', path, exc)
+    return sections
+
+
+class PluginConfig(object):
+    """
+    The compiled configuration of one plugin.
+
+    :ivar env: The complete environment of the plugin, or ``None`` to
+        inherit the node's environment
+    :ivar uid: The user id to run as, or ``None``
+    :ivar gid: The group id to run as, or ``None``
+    :ivar groups: The supplementary group ids, or ``None``
+    :ivar timeout: The timeout in seconds, or ``None`` if not configured
+    :ivar error: A message why the plugin must not run (for example an
+        unknown user), or ``None``
+    """
+
+    def __init__(self, env=None, uid=None, gid=None, groups=None,
+            timeout=None, error=None):
+        self.env = env
+        self.uid = uid
+        self.gid = gid
+        self.groups = groups
+        self.timeout = timeout
+        self.error = error
+
+    def credentials(self):
+        """
+        Returns ``(uid, gid, groups)``, or ``None`` if the plugin runs with
+        the node's own credentials.
+        """
+        if self.uid is None and self.gid is None:
+            return None
+        return self.uid, self.gid, self.groups
+
+
+#: The configuration of plugins without any settings
+DEFAULT_CONFIG = PluginConfig()
+
+
+def _resolve_groups(value):
+    """
+    Returns the list of group ids named in a ``group`` setting.
+
+    :raises KeyError: if a mandatory group does not exist
+    """
+    gids = []
+    for name in value.split(','):
+        name = name.strip()
+        optional = name.startswith('(') and name.endswith(')')
+        if optional:
+            name = name[1:-1].strip()
+        if not name:
+            continue
+        try:
+            if name.isdigit():
+                gids.append(int(name))
+            else:
+                gids.append(grp.getgrnam(name).gr_gid)
+        except KeyError:
+            if not optional:
+                raise KeyError('Unknown group %r' % name)
+    return gids
+
+
+def compile_config(plugin, sections, base_env):
+    """
+    Merges the settings of all ``sections`` matching ``plugin`` into a
+    :py:class:`PluginConfig`.
+    """
+    matching = [section for section in sections if section.matches(plugin)]
+    if not matching:
+        return DEFAULT_CONFIG
+    # exact sections last, longer patterns after shorter ones
+    matching.sort(key=lambda section: (not section.is_wildcard(),
+        len(section.pattern), section.order))
+
+    env = {}
+    settings = {}
+    for section in matching:
+        env.update(section.env)
+        settings.update(section.settings)
+
+    config = PluginConfig()
+    if env:
+        config.env = dict(base_env)
+        config.env.update(env)
+
+    try:
+        if 'timeout' in settings:
+            config.timeout = float(settings['timeout'])
+        if 'user' in settings:
+            user = settings['user']
+            if user.isdigit():
+                entry = pwd.getpwuid(int(user))
+            else:
+                entry = pwd.getpwnam(user)
+            config.uid = entry.pw_uid
+            config.gid = entry.pw_gid
+            config.groups = [group.gr_gid for group in grp.getgrall()
+                if entry.pw_name in group.gr_mem]
+            if config.env is None:
+                config.env = dict(base_env)
+            config.env.update({'USER': entry.pw_name,
+                'LOGNAME': entry.pw_name, 'HOME': entry.pw_dir})
+            config.env.update(env)
+        if 'group' in settings:
+            gids = _resolve_groups(settings['group'])
+            if gids:
+                # like munin-node, the first group becomes the effective
+                # one. The user's primary group stays a supplementary one.
+                groups = set((config.groups or []) + gids)
+                if config.gid is not None:
+                    groups.add(config.gid)
+                config.gid = gids[0]
+                config.groups = sorted(groups)
+    except (KeyError, ValueError), exc:
+        config.error = 'Invalid configuration of %s: %s' % (plugin, exc)
+        LOG.warning(config.error)
+    return config
+
+
+class PluginConfigStore(object):
+    """
+    Compiled plugin configurations of a ``plugin-conf.d`` folder.
+
+    The folder is parsed once. Each plugin's configuration is compiled on
+    first use and cached. Everything is dropped when a file in the folder
+    changes, which is checked at most every :py:data:`CHECK_INTERVAL`
+    seconds.
+
+    :param conf_dir: The configuration folder
+    """
+
+    def __init__(self, conf_dir):
+        self.conf_dir = conf_dir
+        #: Number of times the folder was parsed
+        self.loads = 0
+        self._sections = []
+        self._compiled = {}
+        self._signature = None
+        self._checked_at = 0
+        self._base_env = dict(os.environ)
+        self._lock = threading.Lock()
+
+    def _current_signature(self):
+        try:
+            signature = [stat(self.conf_dir).st_mtime]
+            for filename in sorted(listdir(self.conf_dir)):
+                info = stat(join(self.conf_dir, filename))
+                signature.append((filename, info.st_mtime, info.st_size))
+        except OSError, exc:
+            LOG.warning('Unable to read %s: %s', self.conf_dir, exc)
+            return None
+        return signature
+
+    def _refresh(self):
+        now = time()
+        if self._signature is not None and (
+                now - self._checked_at < CHECK_INTERVAL):
+            return
+        self._checked_at = now
+        signature = self._current_signature()
+        if signature == self._signature and self.loads:
+            return
+        LOG.info('Loading plugin configuration from %s', self.conf_dir)
+        if signature is None:
+            self._sections = []
+        else:
+            self._sections = parse_folder(self.conf_dir)
+        self._signature = signature
+        self._compiled = {}
+        self.loads += 1
+
+    def get(self, plugin):
+        """
+        Returns the :py:class:`PluginConfig` of ``plugin``.
+        """
+        self._lock.acquire()
+        try:
+            self._refresh()
+            config = self._compiled.get(plugin)
+            if config is None:
+                config = compile_config(plugin, self._sections,
+                    self._base_env)
+                self._compiled[plugin] = config
+            return config
+        finally:
+            self._lock.release()
@@ -0,0 +1,118 @@
+"""
+A bounded pool of worker threads used to run plugins concurrently.
+"""
+from time import time
+import logging
+import sys
+import threading
+import Queue
+
+LOG = logging.getLogger(__name__)
+
+
+class Job(object):
+    """
+    The pending result of a function submitted to an :py:class:`ExecutorPool`.
+    """
+
+    def __init__(self, func, args):
+        self.func = func
+        self.args = args
+        self.result = None
+        self.exc_info = None
+        self.submitted = time()
+        #: Seconds the job waited for a worker, once it started
+        self.queue_wait = None
+        self._lock = threading.Lock()
+        self._done = threading.Event()
+        self._state = 'queued'
+
+    def run(self):
+        """
+        Executes the job unless it has been cancelled in the meantime.
+        """
+        self._lock.acquire()
+        try:
+            if self._state != 'queued':
+                return
+            self._state = 'running'
+        finally:
+            self._lock.release()
+        self.queue_wait = time() - self.submitted
+
+        try:
+            try:
+                self.result = self.func(*self.args)
+            except Exception:
+                self.exc_info = sys.exc_info()
+        finally:
+            self._state = 'done'
+            self._done.set()
+
+    def cancel(self):
+        """
+        Cancels the job if it has not started yet. Returns ``True`` on
+        success.
+        """
+        self._lock.acquire()
+        try:
+            if self._state != 'queued':
+                return False
+            self._state = 'cancelled'
+        finally:
+            self._lock.release()
+        self._done.set()
+        return True
+
+    def wait(self):
+        """
+        Blocks until the job has finished and returns its result. Exceptions
+        raised by the job are re-raised here.
+        """
+        self._done.wait()
+        if self._state == 'cancelled':
+            raise RuntimeError('Job was cancelled')
+        if self.exc_info:
+            raise self.exc_info[0], self.exc_info[1], self.exc_info[2]
+        return self.result
+
+
+class ExecutorPool(object):
+    """
+    Runs jobs in at most ``size`` worker threads. Jobs are started in the
+    order they were submitted.
+
+    :param size: The number of worker threads
+    :param stats: An optional :py:class:`stats.Stats` recording how long
+        jobs wait for a worker
+    """
+
+    def __init__(self, size, stats=None):
+        self.size = size
+        self.stats = stats
+        self._queue = Queue.Queue()
+        self._threads = []
+        for i in range(size):
+            thread = threading.Thread(target=self._work,
+                name='plugin-worker-%d' % i)
+            thread.setDaemon(True)
+            thread.start()
+            self._threads.append(thread)
+
+    def _work(self):
+        while True:
+            job = self._queue.get()
+            try:
+                job.run()
+            except Exception:
+                LOG.exception('Unexpected error in worker thread')
+            if self.stats is not None and job.queue_wait is not None:
+                self.stats.observe('queue', 'executor', job.queue_wait)
+
+    def submit(self, func, *args):
+        """
+        Queues ``func(*args)`` for execution and returns its :py:class:`Job`.
+        """
+        job = Job(func, args)
+        self._queue.put(job)
+        return job
@@ -0,0 +1,236 @@
+"""
+Pre-fetching of plugin values shortly before a master polls.
+
+Masters poll on a fixed interval (five minutes by default). The
+:py:class:`PollPredictor` learns the poll times and the fetched plugins of
+each master from the start of its sessions. The :py:class:`PrefetchScheduler`
+runs ``fetch`` for those plugins a few seconds before the next expected poll
+and stages the output, so the actual ``fetch`` is answered from memory.
+
+Every staged result carries a freshness bound: it is only served until
+``max_age`` seconds after its run started. Older results are never served,
+the plugin runs as usual instead.
+"""
+from time import time, sleep
+import logging
+import threading
+
+from cache import ResultCache
+
+LOG = logging.getLogger(__name__)
+
+#: Sessions of one master starting within this many seconds belong to the
+#: same poll
+SAME_POLL = 30
+
+#: The number of poll intervals remembered per master
+HISTORY = 8
+
+#: The number of consistent recent intervals needed for a prediction
+MIN_INTERVALS = 2
+
+#: Intervals may deviate this much (relative to the median) to be consistent
+JITTER = 0.1
+
+#: Default number of seconds the fetches start before the expected poll
+LEAD = 15
+
+#: Default number of seconds a staged result may be served after its run
+#: started
+MAX_AGE = 30
+
+#: Seconds between two checks for due pre-fetches
+TICK = 1
+
+
+class MasterHistory(object):
+    """
+    The recent polls of one master.
+    """
+
+    def __init__(self):
+        #: Start times of the recent polls, oldest first
+        self.polls = []
+        #: The plugins fetched during the latest poll
+        self.plugins = set()
+
+    def record(self, started, plugins):
+        """
+        Records a session which started at ``started`` and fetched
+        ``plugins``.
+        """
+        if self.polls and started - self.polls[-1] < SAME_POLL:
+            self.plugins.update(plugins)
+            return
+        self.polls.append(started)
+        del self.polls[:-(HISTORY + 1)]
+        self.plugins = set(plugins)
+
+    def period(self):
+        """
+        Returns the poll interval in seconds, or ``None`` if the polls are
+        not regular (yet).
+        """
+        intervals = [b - a for a, b in zip(self.polls, self.polls[1:])]
+        if len(intervals) < MIN_INTERVALS:
+            return None
+        median = sorted(intervals)[len(intervals) // 2]
+        for interval in intervals[-MIN_INTERVALS:]:
+            if abs(interval - median) > JITTER * median:
+                return None
+        return median
+
+    def next_poll(self, now):
+        """
+        Returns the expected time of the next poll, or ``None`` if it cannot
+        be predicted or the master seems to have stopped polling.
+        """
+        period = self.period()
+        if period is None:
+            return None
+        if now - self.polls[-1] > 2 * period:
+            return None
+        return self.polls[-1] + period
+
+
+class PollPredictor(object):
+    """
+    Learns the poll times of all masters.
+    """
+
+    def __init__(self):
+        self._masters = {}
+        self._lock = threading.Lock()
+
+    def record(self, master, started, plugins):
+        """
+        Records a session of ``master`` (its address) which started at
+        ``started`` and fetched ``plugins``. Sessions without fetches are
+        ignored, as they are no polls.
+        """
+        if not plugins:
+            return
+        self._lock.acquire()
+        try:
+            history = self._masters.get(master)
+            if history is None:
+                history = self._masters[master] = MasterHistory()
+            history.record(started, plugins)
+        finally:
+            self._lock.release()
+
+    def upcoming(self, now):
+        """
+        Returns a list of ``(master, expected poll time, plugins)`` for all
+        masters with a predictable next poll.
+        """
+        result = []
+        self._lock.acquire()
+        try:
+            for master, history in self._masters.items():
+                expected = history.next_poll(now)
+                if expected is not None:
+                    result.append((master, expected, set(history.plugins)))
+        finally:
+            self._lock.release()
+        return result
+
+
+class PrefetchScheduler(object):
+    """
+    Background thread running the fetches of the predicted polls.
+
+    :param run_plugin: Callable taking a plugin name and a command, returning
+        the plugin output
+    :param lead: Seconds the fetches start before the expected poll
+    :param max_age: Seconds a staged result may be served after its run
+        started
+    :param executor: An optional :py:class:`pool.ExecutorPool` running the
+        fetches concurrently
+    """
+
+    def __init__(self, run_plugin, lead=LEAD, max_age=MAX_AGE,
+            executor=None):
+        self.run_plugin = run_plugin
+        self.lead = lead
+        self.max_age = max_age
+        self.executor = executor
+        self.predictor = PollPredictor()
+        self.staged = ResultCache(max_age, max_entries=4096)
+        #: Number of plugin runs started by the scheduler
+        self.runs = 0
+        self._prepared = {}  # master -> expected poll time already prepared
+        self._thread = None
+
+    def record(self, master, started, plugins):
+        """
+        Learns from a finished session. See :py:meth:`PollPredictor.record`.
+        """
+        self.predictor.record(master, started, plugins)
+
+    def get(self, plugin):
+        """
+        Returns the staged fetch output of ``plugin``, or ``None`` if there
+        is no fresh one.
+        """
+        return self.staged.get(plugin, 'fetch')
+
+    def has(self, plugin):
+        """
+        Returns ``True`` if a fresh fetch output of ``plugin`` is staged.
+        """
+        return self.staged.has(plugin, 'fetch')
+
+    def _prefetch(self, plugin):
+        started = time()
+        try:
+            output = self.run_plugin(plugin, 'fetch')
+        except OSError, exc:
+            LOG.warning('Unable to pre-fetch %s: %s', plugin, exc)
+            return
+        # the freshness bound counts from the start of the run
+        remaining = self.max_age - (time() - started)
+        if remaining > 0:
+            self.staged.put(plugin, 'fetch', output, ttl=remaining)
+
+    def check(self, now=None):
+        """
+        Starts the fetches of all polls expected within the lead time.
+        """
+        if now is None:
+            now = time()
+        plugins = set()
+        for master, expected, master_plugins in self.predictor.upcoming(now):
+            if expected - self.lead > now:
+                continue
+            if self._prepared.get(master) == expected:
+                continue
+            self._prepared[master] = expected
+            LOG.debug('Pre-fetching %d plugins for %s, expected to poll in '
+                '%.1f seconds', len(master_plugins), master, expected - now)
+            plugins.update(master_plugins)
+
+        for plugin in sorted(plugins):
+            if self.has(plugin):
+                continue
+            self.runs += 1
+            if self.executor is not None:
+                self.executor.submit(self._prefetch, plugin)
+            else:
+                self._prefetch(plugin)
+
+    def _loop(self):
+        while True:
+            sleep(TICK)
+            try:
+                self.check()
+            except Exception:
+                LOG.exception('Pre-fetch failed')
+
+    def start(self):
+        """
+        Starts the scheduler thread.
+        """
+        self._thread = threading.Thread(target=self._loop, name='prefetch')
+        self._thread.setDaemon(True)
+        self._thread.start()
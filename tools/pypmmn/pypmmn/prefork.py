@@ -0,0 +1,359 @@
+"""
+Pre-forked multi-process serving.
+
+One CPython process only uses one CPU core. In pre-fork mode, a supervisor
+process forks a number of workers which all accept connections on the same
+port, either through their own ``SO_REUSEPORT`` listener (letting the kernel
+balance the connections) or through one inherited listening socket where
+``SO_REUSEPORT`` is not available.
+
+The supervisor restarts workers which die and collects their statistics.
+Every worker regularly sends its :py:meth:`stats.Stats.snapshot` over a
+socket pair and gets the merged numbers of all workers back, so the
+``pypmmn_stats`` plugin reports the whole node no matter which worker
+answers.
+"""
+from errno import EINTR, ECHILD
+from time import time, sleep
+import json
+import logging
+import os
+import select
+import signal
+import socket
+import threading
+
+import asynclog
+from protocol import LineBuffer
+from stats import Stats, merge_snapshots
+
+LOG = logging.getLogger(__name__)
+
+#: ``SO_REUSEPORT`` is missing from the socket module of older pythons
+SO_REUSEPORT = getattr(socket, 'SO_REUSEPORT', 15)
+
+#: Seconds between two statistics reports of a worker
+REPORT_INTERVAL = 5
+
+#: Workers dying sooner than this many seconds after their start are
+#: restarted with an increasing delay
+MIN_UPTIME = 10
+
+#: The longest delay (in seconds) before restarting a crashing worker
+MAX_RESTART_DELAY = 60
+
+#: The largest statistics report accepted from a worker (in bytes)
+MAX_REPORT_SIZE = 16 * 1024 * 1024
+
+
+def reuse_port_supported():
+    """
+    Returns ``True`` if the system allows several sockets to listen on the
+    same port.
+    """
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    try:
+        try:
+            sock.setsockopt(socket.SOL_SOCKET, SO_REUSEPORT, 1)
+        except socket.error:
+            return False
+        return True
+    finally:
+        sock.close()
+
+
+def native(value):
+    """
+    Converts the unicode strings of a decoded JSON document into byte
+    strings.
+    """
+    if isinstance(value, dict):
+        return dict((native(key), native(item))
+            for key, item in value.items())
+    if isinstance(value, list):
+        return [native(item) for item in value]
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    return value
+
+
+class MetricsReporter(object):
+    """
+    Thread inside a worker sending its statistics to the supervisor and
+    storing the merged statistics of all workers in ``stats.shared``.
+
+    A worker losing its supervisor exits.
+
+    :param stats: The :py:class:`stats.Stats` of the worker
+    :param sock: The worker's end of the socket pair
+    :param interval: Seconds between two reports
+    """
+
+    def __init__(self, stats, sock, interval=REPORT_INTERVAL):
+        self.stats = stats
+        self.sock = sock
+        self.interval = interval
+        self._thread = None
+
+    def _loop(self):
+        reply = self.sock.makefile('rb')
+        while True:
+            try:
+                self.sock.sendall(json.dumps(self.stats.snapshot()) + '\n')
+                line = reply.readline()
+            except socket.error, exc:
+                LOG.debug('Statistics report failed: %s', exc)
+                line = ''
+            if not line:
+                LOG.error('Lost the supervisor. Exiting.')
+                asynclog.flush_all()
+                os._exit(1)
+            self.stats.shared = native(json.loads(line))
+            sleep(self.interval)
+
+    def start(self):
+        """
+        Starts the reporter thread.
+        """
+        self._thread = threading.Thread(target=self._loop,
+            name='metrics-reporter')
+        self._thread.setDaemon(True)
+        self._thread.start()
+
+
+class WorkerProcess(object):
+    """
+    The supervisor's view of one worker.
+    """
+
+    def __init__(self, number, pid, sock):
+        self.number = number
+        self.pid = pid
+        self.sock = sock
+        self.started = time()
+        self.snapshot = None
+        self.reader = LineBuffer(MAX_REPORT_SIZE)
+
+
+class Supervisor(object):
+    """
+    Forks and supervises the worker processes.
+
+    :param processes: The number of workers
+    :param worker_fun: Called as ``worker_fun(number, stats)`` inside each
+        worker to serve connections. ``number`` counts from ``0`` to
+        ``processes - 1`` and is kept when a worker is restarted. ``stats``
+        is the :py:class:`stats.Stats` of the worker. It should never return.
+    :param stats_filename: The merged statistics are written as JSON into
+        this file on ``SIGUSR1``
+    """
+
+    def __init__(self, processes, worker_fun, stats_filename):
+        self.processes = processes
+        self.worker_fun = worker_fun
+        self.stats_filename = stats_filename
+        self.workers = {}
+        self.restarts = 0
+        self._running = True
+        self._pending = []  # (restart time, number)
+        self._delays = {}
+        # the counters of exited workers by worker number
+        self._retired = {}
+
+    def _spawn(self, number):
+        parent_sock, child_sock = socket.socketpair()
+        pid = os.fork()
+        if pid == 0:
+            parent_sock.close()
+            for worker in self.workers.values():
+                if worker.sock is not None:
+                    worker.sock.close()
+            self._run_worker(number, child_sock)
+        child_sock.close()
+        self.workers[pid] = WorkerProcess(number, pid, parent_sock)
+        LOG.info('Started worker %d with PID %d', number, pid)
+
+    def _run_worker(self, number, sock):
+        """
+        The body of a worker process. Never returns.
+        """
+        try:
+            asynclog.reinit_after_fork()
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            signal.signal(signal.SIGINT, signal.SIG_DFL)
+            signal.signal(signal.SIGUSR1, signal.SIG_IGN)
+            stats = Stats()
+            MetricsReporter(stats, sock).start()
+            self.worker_fun(number, stats)
+        except SystemExit:
+            pass
+        except Exception:
+            LOG.exception('Worker %d failed', number)
+        asynclog.flush_all()
+        os._exit(1)
+
+    def _stop(self, signum, frame):
+        LOG.info('Received signal %d. Stopping the workers.', signum)
+        self._running = False
+
+    def _dump(self, signum, frame):
+        try:
+            fptr = open(self.stats_filename, 'w')
+            try:
+                fptr.write(json.dumps(self.aggregate(), indent=2,
+                    sort_keys=True))
+            finally:
+                fptr.close()
+        except IOError, exc:
+            LOG.warning('Unable to write statistics: %s', exc)
+            return
+        LOG.info('Statistics written to %s', self.stats_filename)
+
+    def aggregate(self):
+        """
+        Returns the merged statistics of all current and former workers.
+        """
+        snapshots = self._retired.values()
+        snapshots.extend(worker.snapshot for worker in self.workers.values()
+            if worker.snapshot is not None)
+        result = merge_snapshots(snapshots)
+        result['processes'] = len(self.workers)
+        result['restarts'] = self.restarts
+        return result
+
+    def _retire(self, worker):
+        """
+        Keeps the counters of an exited worker, so the merged counters never
+        decrease.
+        """
+        if worker.snapshot is None:
+            return
+        kept = {}
+        for key in ('counters', 'histograms', 'timeouts'):
+            if key in worker.snapshot:
+                kept[key] = worker.snapshot[key]
+        retired = self._retired.get(worker.number)
+        if retired is not None:
+            kept = merge_snapshots([retired, kept])
+        self._retired[worker.number] = kept
+
+    def _reap(self):
+        while True:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except OSError, exc:
+                if exc.errno == EINTR:
+                    continue
+                if exc.errno == ECHILD:
+                    return
+                raise
+            if not pid:
+                return
+            worker = self.workers.pop(pid, None)
+            if worker is None:
+                continue
+            if worker.sock is not None:
+                worker.sock.close()
+            self._retire(worker)
+            if not self._running:
+                continue
+
+            uptime = time() - worker.started
+            if uptime < MIN_UPTIME:
+                delay = min(self._delays.get(worker.number, 0.5) * 2,
+                    MAX_RESTART_DELAY)
+            else:
+                delay = 0
+            self._delays[worker.number] = delay
+            LOG.warning('Worker %d (PID %d) exited with status %d after '
+                '%.1f seconds. Restarting it in %.1f seconds.',
+                worker.number, pid, status, uptime, delay)
+            self._pending.append((time() + delay, worker.number))
+
+    def _restart_pending(self):
+        now = time()
+        for entry in list(self._pending):
+            restart_at, number = entry
+            if restart_at <= now:
+                self._pending.remove(entry)
+                self.restarts += 1
+                self._spawn(number)
+
+    def _handle_report(self, worker):
+        try:
+            data = worker.sock.recv(65536)
+        except socket.error, exc:
+            if exc.args[0] == EINTR:
+                return
+            data = ''
+        if not data:
+            # the worker is exiting, it is reaped later on
+            worker.sock.close()
+            worker.sock = None
+            return
+        try:
+            lines = worker.reader.feed(data)
+        except ValueError, exc:
+            LOG.warning('Invalid report from worker %d: %s',
+                worker.number, exc)
+            return
+        for line in lines:
+            try:
+                worker.snapshot = json.loads(line)
+            except ValueError, exc:
+                LOG.warning('Invalid report from worker %d: %s',
+                    worker.number, exc)
+            try:
+                worker.sock.sendall(json.dumps(self.aggregate()) + '\n')
+            except socket.error, exc:
+                LOG.debug('Unable to answer worker %d: %s',
+                    worker.number, exc)
+
+    def _read_reports(self, timeout):
+        socks = {}
+        for worker in self.workers.values():
+            if worker.sock is not None:
+                socks[worker.sock.fileno()] = worker
+        if not socks:
+            sleep(timeout)
+            return
+        try:
+            readable = select.select(socks.keys(), [], [], timeout)[0]
+        except select.error, exc:
+            if exc.args[0] == EINTR:
+                return
+            raise
+        for fd in readable:
+            self._handle_report(socks[fd])
+
+    def _shutdown(self):
+        for pid in self.workers.keys():
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except OSError:
+                pass
+        while self.workers:
+            try:
+                pid = os.wait()[0]
+            except OSError, exc:
+                if exc.errno == EINTR:
+                    continue
+                break
+            self.workers.pop(pid, None)
+        LOG.info('All workers stopped.')
+
+    def run(self):
+        """
+        Starts the workers and supervises them until ``SIGTERM`` or
+        ``SIGINT`` arrives.
+        """
+        signal.signal(signal.SIGTERM, self._stop)
+        signal.signal(signal.SIGINT, self._stop)
+        signal.signal(signal.SIGUSR1, self._dump)
+        for number in range(self.processes):
+            self._spawn(number)
+        while self._running:
+            self._reap()
+            self._restart_pending()
+            self._read_reports(1)
+        self._shutdown()
@@ -0,0 +1,96 @@
+"""
+Helpers for the line based munin protocol: splitting incoming data into
+command lines and batching outgoing data into few large writes.
+"""
+
+#: The longest command line accepted from a master (in bytes)
+MAX_LINE_LENGTH = 4096
+
+#: Outgoing data is flushed once this many bytes are buffered
+FLUSH_SIZE = 64 * 1024
+
+
+def frame_multigraph(plugin, output):
+    """
+    Prefixes the fetch ``output`` of ``plugin`` with a ``multigraph`` line,
+    so it can be sent together with the output of other plugins. Output of
+    multigraph plugins already carries such lines and is left alone.
+    """
+    if output and not output.endswith('\n'):
+        output += '\n'
+    if output.lstrip().startswith('multigraph '):
+        return output
+    return 'multigraph %s\n%s' % (plugin, output)
+
+
+class LineTooLong(ValueError):
+    """
+    Raised when a master sends more than :py:data:`MAX_LINE_LENGTH` bytes
+    without a line break.
+    """
+
+
+class LineBuffer(object):
+    """
+    Incrementally splits received data into lines. Data after the last line
+    break is kept until the rest of the line arrives.
+
+    :param max_length: The maximum number of bytes kept for an incomplete
+        line
+    """
+
+    def __init__(self, max_length=MAX_LINE_LENGTH):
+        self.max_length = max_length
+        self._pending = ''
+
+    def feed(self, data):
+        """
+        Adds ``data`` and returns the list of lines it completed, without
+        their line breaks.
+
+        :raises LineTooLong: if the incomplete line grows beyond the limit
+        """
+        lines = (self._pending + data).split('\n')
+        self._pending = lines.pop()
+        if len(self._pending) > self.max_length:
+            self._pending = ''
+            raise LineTooLong('Line longer than %d bytes' % self.max_length)
+        return [line.rstrip('\r') for line in lines]
+
+
+class OutputBuffer(object):
+    """
+    Collects the output of commands and sends it in batches.
+
+    :param send_fun: The function sending the data, for example
+        ``socket.sendall``.
+    :param flush_size: Flush automatically once this many bytes are pending
+    """
+
+    def __init__(self, send_fun, flush_size=FLUSH_SIZE):
+        self.send_fun = send_fun
+        self.flush_size = flush_size
+        self._chunks = []
+        self._size = 0
+
+    def write(self, data):
+        """
+        Queues ``data``. Usable as ``put_fun`` of a command handler.
+        """
+        if not data:
+            return
+        self._chunks.append(data)
+        self._size += len(data)
+        if self._size >= self.flush_size:
+            self.flush()
+
+    def flush(self):
+        """
+        Sends everything queued so far in one call.
+        """
+        if not self._chunks:
+            return
+        data = ''.join(self._chunks)
+        self._chunks = []
+        self._size = 0
+        self.send_fun(data)
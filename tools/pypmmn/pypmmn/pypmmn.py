@@ -3,23 +3,42 @@
 A very simple munin-node written in pure python (no external libraries
 required)
 """
-from datetime import datetime
+from errno import ENOENT, EINTR
 from logging.handlers import RotatingFileHandler
 from optparse import OptionParser
-from os import listdir, access, X_OK, getpid
-from os.path import join, isdir, abspath, dirname, exists
+from os import getpid
+from os.path import join, abspath, basename, dirname, exists, getmtime
 from subprocess import Popen, PIPE
-from time import sleep
+from time import time
 import logging
+import signal
 import socket
+import tempfile
+import threading
 
 import sys
 
 LOG = logging.getLogger(__name__)
 LOG_FORMAT = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
 SESSION_TIMEOUT = 10 # Amount of seconds until an unused session is closed
+RECV_SIZE = 4096
+CACHEABLE_COMMANDS = ('config', 'fetch')
+VARIADIC_COMMANDS = ('multifetch', )
 
 from daemon import createDaemon
+from eventloop import EventLoop, Server
+from pool import ExecutorPool
+from cache import ResultCache
+from spool import Spool, SpoolCollector
+from warm import WarmPythonPool
+from runner import PluginRunner, PluginTimeout, OutputTooLarge, MAX_OUTPUT
+from index import PluginIndex
+from protocol import LineBuffer, LineTooLong, OutputBuffer, frame_multigraph
+from stats import Stats, STATS_PLUGIN
+from prefork import Supervisor, SO_REUSEPORT, reuse_port_supported
+from prefetch import PrefetchScheduler
+from pluginconf import PluginConfigStore
+from asynclog import AsyncHandler, DebugSampler
 
 
 __version__ = '1.0b1'
@@ -32,23 +51,72 @@ class CmdHandler(object):
     command.
     """
 
-    def __init__(self, get_fun, put_fun, options):
+    def __init__(self, get_fun, put_fun, options, executor=None, cache=None,
+            spool=None, runner=None, index=None, stats=None, prefetch=None):
         """
         Constructor
 
         :param get_fun: The function used to receive a message from munin
         :param put_fun: The function used to send a message back to munin
         :param options: The command-line options object
+        :param executor: An optional :py:class:`pool.ExecutorPool`. If given,
+            plugins are run speculatively in the pool (see
+            :py:meth:`speculate`).
+        :param cache: An optional :py:class:`cache.ResultCache` shared by all
+            sessions.
+        :param spool: An optional :py:class:`spool.Spool` used to answer
+            ``spoolfetch`` natively.
+        :param runner: The :py:class:`runner.PluginRunner` executing the
+            plugins. Defaults to one without timeouts.
+        :param index: The :py:class:`index.PluginIndex` of the plugin folder.
+            Sessions should share one, so the folder is only scanned once.
+        :param stats: The :py:class:`stats.Stats` recording the performance
+            of this node. It is published as plugin ``pypmmn_stats``.
+        :param prefetch: An optional :py:class:`prefetch.PrefetchScheduler`.
+            Sessions teach it the poll times of the masters, and ``fetch``
+            uses the results it staged.
         """
+        if stats is None:
+            stats = Stats()
+        self.stats = stats
         self.get_fun = get_fun
         self.put_fun = put_fun
         self.options = options
+        self.executor = executor
+        self.cache = cache
+        self.spool = spool
+        if runner is None:
+            runner = PluginRunner()
+        self.runner = runner
+        if index is None:
+            index = PluginIndex(options.plugin_dir, use_inotify=False)
+        self.index = index
+        self.prefetch = prefetch
+        self.master_capabilities = set()
+        self._session_peer = None
+        self._session_started = None
+        self._session_fetches = set()
+        self._speculative = {}
+        self._speculative_lock = threading.Lock()
+
+    def _get_put_fun(self):
+        return self._counting_put
+
+    def _set_put_fun(self, put_fun):
+        self._put_fun = put_fun
+
+    #: Sends a message back to munin, counting the bytes sent
+    put_fun = property(_get_put_fun, _set_put_fun)
+
+    def _counting_put(self, data):
+        self.stats.incr('bytes_sent', len(data))
+        self._put_fun(data)
 
     def do_version(self, arg):
         """
         Prints the version of this instance.
         """
-        LOG.debug('Command "version" executed with args: %r' % arg)
+        LOG.debug('Command "version" executed with args: %r', arg)
         self.put_fun('# munin node at %s\n' % (
             self.options.host,
             ))
@@ -57,7 +125,7 @@ class CmdHandler(object):
         """
         Prints this hostname
         """
-        LOG.debug('Command "nodes" executed with args: %r' % arg)
+        LOG.debug('Command "nodes" executed with args: %r', arg)
         self.put_fun('%s\n' % self.options.host)
         self.put_fun('.\n')
 
@@ -65,26 +133,200 @@ class CmdHandler(object):
         """
         Stops this process
         """
-        LOG.debug('Command "quit" executed with args: %r' % arg)
+        LOG.debug('Command "quit" executed with args: %r', arg)
         sys.exit(0)
 
+    def list_plugins(self):
+        """
+        Returns the names of all executable plugins.
+
+        :raises OSError: if the plugin folder cannot be read
+        """
+        return self.index.names()
+
     def do_list(self, arg):
         """
         Print a list of plugins
         """
-        LOG.debug('Command "list" executed with args: %r' % arg)
+        LOG.debug('Command "list" executed with args: %r', arg)
         try:
-            LOG.debug('Listing files inside %s' % self.options.plugin_dir)
-            for filename in listdir(self.options.plugin_dir):
-                if not access(join(self.options.plugin_dir, filename), X_OK):
-                    LOG.warning('Non-executable plugin %s found!' % filename)
-                    continue
-                LOG.debug('Found plugin: %s' % filename)
+            for filename in self.list_plugins():
                 self.put_fun("%s " % filename)
+            # the stats plugin is a multigraph plugin
+            if 'multigraph' in self.master_capabilities:
+                self.put_fun("%s " % STATS_PLUGIN)
         except OSError, exc:
             self.put_fun("# ERROR: %s" % exc)
         self.put_fun("\n")
 
+    def _plugin_filename(self, plugin):
+        """
+        Returns the full path of ``plugin``, or ``None`` if it is not an
+        executable plugin.
+        """
+        return self.index.lookup(plugin)
+
+    def _mtime(self, plugin_filename):
+        """
+        Returns the modification time of a plugin or ``None`` if it cannot
+        be determined.
+        """
+        try:
+            return getmtime(plugin_filename)
+        except OSError:
+            return None
+
+    def _is_cached(self, plugin, plugin_filename, cmd):
+        if (self.prefetch is not None and cmd == 'fetch' and
+                self.prefetch.has(plugin)):
+            return True
+        if self.cache is None or cmd not in CACHEABLE_COMMANDS:
+            return False
+        return self.cache.has(plugin, cmd, self._mtime(plugin_filename))
+
+    def _execute(self, plugin_filename, cmd, put_fun=None):
+        """
+        Runs the plugin executable and returns its output.
+
+        :param plugin_filename: The full path of the plugin
+        :param cmd: The munin command (``config``, ``alert`` or ``fetch``)
+        :param put_fun: If given, the output is passed to ``put_fun`` in
+            chunks as the plugin writes it, and ``None`` is returned
+        """
+        # for 'fetch' we don't need to pass a command to the plugin
+        if cmd == 'fetch':
+            plugin_arg = ''
+        else:
+            plugin_arg = cmd
+
+        start = time()
+        try:
+            if put_fun is not None:
+                return self.runner.stream(plugin_filename, plugin_arg,
+                    put_fun)
+            return self.runner.run(plugin_filename, plugin_arg)
+        finally:
+            self.stats.observe('plugin', basename(plugin_filename),
+                time() - start)
+
+    def _run(self, plugin, plugin_filename, cmd, put_fun=None):
+        """
+        Executes a plugin and stores the result in the cache (if enabled).
+        Speculative runs are cached as well, even if the session never asks
+        for them.
+
+        :param put_fun: If given, the output is streamed to ``put_fun`` (see
+            :py:meth:`_execute`) and ``None`` is returned
+        """
+        if self.cache is None or cmd not in CACHEABLE_COMMANDS:
+            return self._execute(plugin_filename, cmd, put_fun)
+        mtime = self._mtime(plugin_filename)
+        if put_fun is None:
+            output = self._execute(plugin_filename, cmd)
+            self.cache.put(plugin, cmd, output, mtime)
+            return output
+
+        chunks = []
+        def tee(data):
+            chunks.append(data)
+            put_fun(data)
+        self._execute(plugin_filename, cmd, tee)
+        self.cache.put(plugin, cmd, ''.join(chunks), mtime)
+
+    def run_plugin(self, plugin, cmd):
+        """
+        Runs ``plugin`` with the munin command ``cmd`` and returns its
+        output.
+
+        :raises OSError: if the plugin does not exist or cannot be executed
+        """
+        plugin_filename = self._plugin_filename(plugin)
+        if not plugin_filename:
+            raise OSError(ENOENT, 'Unknown plugin [%s]' % plugin)
+        return self._run(plugin, plugin_filename, cmd)
+
+    def speculate(self, requests):
+        """
+        Starts plugins in the executor pool before munin asks for them. The
+        result is picked up by the next matching command of this session.
+
+        Does nothing if no executor pool is available.
+
+        :param requests: A list of ``(plugin, cmd)`` tuples
+        """
+        if self.executor is None:
+            return
+        self._speculative_lock.acquire()
+        try:
+            for plugin, cmd in requests:
+                if (plugin, cmd) in self._speculative:
+                    continue
+                plugin_filename = self._plugin_filename(plugin)
+                if not plugin_filename:
+                    continue
+                if self._is_cached(plugin, plugin_filename, cmd):
+                    continue
+                LOG.debug('Speculatively starting %r for %s', cmd, plugin)
+                self._speculative[plugin, cmd] = self.executor.submit(
+                    self._run, plugin, plugin_filename, cmd)
+        finally:
+            self._speculative_lock.release()
+
+    def speculate_lines(self, lines):
+        """
+        Speculatively starts every ``config`` and ``fetch`` found in a batch
+        of input lines.
+        """
+        requests = []
+        for line in lines:
+            line = line.strip().split(' ')
+            if len(line) == 2 and line[0] in ('config', 'fetch'):
+                requests.append((line[1], line[0]))
+        self.speculate(requests)
+
+    def start_session(self, peer=None):
+        """
+        Called when a new master connects. Speculatively fetches all plugins
+        if an executor pool is available.
+
+        :param peer: The address of the master, used to learn its poll times
+        """
+        self.master_capabilities = set()
+        self._session_peer = peer
+        self._session_started = time()
+        self._session_fetches = set()
+        self.stats.incr('sessions')
+        self.stats.gauge('active_sessions', 1)
+        if self.executor is None:
+            return
+        try:
+            plugins = self.list_plugins()
+        except OSError, exc:
+            LOG.warning('Unable to list plugins: %s', exc)
+            return
+        self.speculate([(plugin, 'fetch') for plugin in plugins])
+
+    def end_session(self):
+        """
+        Called when the master disconnects. Drops any speculative results
+        which were not picked up.
+        """
+        self.stats.gauge('active_sessions', -1)
+        if self.prefetch is not None and self._session_peer is not None:
+            self.prefetch.record(self._session_peer, self._session_started,
+                self._session_fetches)
+        self._speculative_lock.acquire()
+        try:
+            for job in self._speculative.values():
+                job.cancel()
+            self._speculative.clear()
+        finally:
+            self._speculative_lock.release()
+        if self.cache is not None:
+            LOG.info('Result cache: %d entries, %d hits, %d misses, '
+                '%d evictions', len(self.cache), self.cache.hits,
+                self.cache.misses, self.cache.evictions)
+
     def _caf(self, plugin, cmd):
         """
         handler for ``config``, ``alert`` and ``fetch``
@@ -93,74 +335,219 @@ class CmdHandler(object):
         :param plugin: The plugin name
         :param cmd: The command which is to passed to the plugin
         """
-        plugin_filename = join(self.options.plugin_dir, plugin)
+        output = self._builtin_output(plugin, cmd)
+        if output is not None:
+            self.put_fun(output)
+            self.put_fun('.\n')
+            return
+
+        plugin_filename = self._plugin_filename(plugin)
 
         # Sanity checks
-        if isdir(plugin_filename) or not access(plugin_filename, X_OK):
+        if not plugin_filename:
             msg = "# Unknown plugin [%s] for %s" % (plugin, cmd)
             LOG.warning(msg)
             self.put_fun(msg)
             return
 
-        # for 'fetch' we don't need to pass a command to the plugin
-        if cmd == 'fetch':
-            plugin_arg = ''
-        else:
-            plugin_arg = cmd
+        # Part of the output may be sent already when the plugin fails. The
+        # message must not end up on the same line as a value.
+        last = ['\n']
+        def put(data):
+            if data:
+                last[0] = data[-1]
+            self.put_fun(data)
+        def end_line():
+            if last[0] != '\n':
+                self.put_fun('\n')
 
         try:
-            cmd = [plugin_filename, plugin_arg]
-            LOG.debug('Executing %r' % cmd)
-            output = Popen(cmd, stdout=PIPE).communicate()[0]
+            output = self._output(plugin, plugin_filename, cmd, put)
+        except PluginTimeout, exc:
+            end_line()
+            self.put_fun("# Timed out by pypmmn: %s\n" % exc.strerror)
+            self.put_fun('.\n')
+            return
+        except OutputTooLarge, exc:
+            # End the response, so the master stays in sync.
+            end_line()
+            self.put_fun("# Output truncated by pypmmn: %s\n" % (
+                exc.strerror))
+            self.put_fun('.\n')
+            return
         except OSError, exc:
-            LOG.exception("Unable to execute the command %r" % cmd)
+            LOG.exception("Unable to execute the command %r", cmd)
+            end_line()
             self.put_fun("# ERROR: %s\n" % exc)
             return
-        self.put_fun(output)
+        if output is not None:
+            self.put_fun(output)
         self.put_fun('.\n')
 
+    def _builtin_output(self, plugin, cmd):
+        """
+        Returns the output of the built-in plugin ``plugin`` for ``cmd``, or
+        ``None`` if ``plugin`` is not a built-in one.
+        """
+        if plugin != STATS_PLUGIN:
+            return None
+        if cmd == 'config':
+            return self.stats.munin_config()
+        if cmd == 'fetch':
+            return self.stats.munin_fetch()
+        return ''
+
+    def _output(self, plugin, plugin_filename, cmd, put_fun=None):
+        """
+        Returns the output of ``plugin`` for ``cmd``. Uses a cached result
+        or a speculatively started run if available and runs the plugin
+        otherwise.
+
+        :param put_fun: If given, the output of a plugin run started here is
+            streamed to ``put_fun`` and ``None`` is returned
+        :raises OSError: if the plugin cannot be executed
+        """
+        if cmd == 'fetch':
+            self._session_fetches.add(plugin)
+            if self.prefetch is not None:
+                output = self.prefetch.get(plugin)
+                if output is not None:
+                    LOG.debug('Using pre-fetched values of %s', plugin)
+                    return output
+
+        if self.cache is not None and cmd in CACHEABLE_COMMANDS:
+            output = self.cache.get(plugin, cmd,
+                self._mtime(plugin_filename))
+            if output is not None:
+                LOG.debug('Cache hit for %r of %s', cmd, plugin)
+                return output
+
+        self._speculative_lock.acquire()
+        try:
+            job = self._speculative.pop((plugin, cmd), None)
+        finally:
+            self._speculative_lock.release()
+        if job is not None and job.cancel():
+            # Still waiting for a free worker. Run it right away instead.
+            job = None
+
+        if job is not None:
+            return job.wait()
+        return self._run(plugin, plugin_filename, cmd, put_fun)
+
     def do_alert(self, arg):
         """
         Handle command "alert"
         """
-        LOG.debug('Command "alert" executed with args: %r' % arg)
+        LOG.debug('Command "alert" executed with args: %r', arg)
         self._caf(arg, 'alert')
 
     def do_fetch(self, arg):
         """
         Handles command "fetch"
         """
-        LOG.debug('Command "fetch" executed with args: %r' % arg)
+        LOG.debug('Command "fetch" executed with args: %r', arg)
         self._caf(arg, 'fetch')
 
     def do_config(self, arg):
         """
         Handles command "config"
         """
-        LOG.debug('Command "config" executed with args: %r' % arg)
+        LOG.debug('Command "config" executed with args: %r', arg)
         self._caf(arg, 'config')
 
+    def do_multifetch(self, arg):
+        """
+        Handles command "multifetch" (advertised as capability
+        ``multifetch``).
+
+        Fetches all plugins given as space separated arguments, or every
+        plugin if there are none, and sends the values as one response.
+        Each plugin's values are introduced by a ``multigraph <plugin>``
+        line, unless the plugin is a multigraph plugin itself. The response
+        ends with a single ``.`` line.
+        """
+        LOG.debug('Command "multifetch" executed with args: %r', arg)
+        if arg:
+            plugins = arg.split()
+        else:
+            try:
+                plugins = self.list_plugins()
+            except OSError, exc:
+                self.put_fun("# ERROR: %s\n" % exc)
+                self.put_fun('.\n')
+                return
+
+        # run all of them at once if we have a worker pool
+        self.speculate([(plugin, 'fetch') for plugin in plugins])
+
+        for plugin in plugins:
+            output = self._builtin_output(plugin, 'fetch')
+            if output is not None:
+                self.put_fun(output)
+                continue
+            plugin_filename = self._plugin_filename(plugin)
+            if not plugin_filename:
+                msg = "# Unknown plugin [%s] for multifetch" % plugin
+                LOG.warning(msg)
+                self.put_fun(msg + '\n')
+                continue
+            # Collected instead of streamed, as the multigraph line has to
+            # go first. On failure the values read so far are still sent.
+            chunks = []
+            try:
+                output = self._output(plugin, plugin_filename, 'fetch',
+                    chunks.append)
+            except PluginTimeout, exc:
+                message = "# Timed out by pypmmn: %s\n" % exc.strerror
+            except OutputTooLarge, exc:
+                message = "# Output truncated by pypmmn: %s\n" % (
+                    exc.strerror)
+            except OSError, exc:
+                # the plugin failed, no need for a traceback
+                LOG.error("Unable to fetch %r: %s", plugin, exc)
+                message = "# ERROR: %s: %s\n" % (plugin, exc)
+            else:
+                if output is None:
+                    output = ''.join(chunks)
+                self.put_fun(frame_multigraph(plugin, output))
+                continue
+            self.put_fun(frame_multigraph(plugin, ''.join(chunks)) + message)
+        self.put_fun('.\n')
+
     def do_cap(self, arg):
         """
         Handles command "cap"
         """
-        LOG.debug('Command "cap" executed with args: %r' % arg)
-        self.put_fun("cap ")
-        if self.options.spoolfetch_dir:
-            self.put_fun("spool")
+        LOG.debug('Command "cap" executed with args: %r', arg)
+        self.master_capabilities = set(arg.split())
+        capabilities = ['multifetch', 'multigraph']
+        if self.spool is not None or self.options.spoolfetch_dir:
+            capabilities.append('spool')
         else:
             LOG.debug('No spoolfetch_dir specified. Result spooling disabled')
 
-        self.put_fun("\n")
+        self.put_fun("cap %s\n" % ' '.join(capabilities))
 
     def do_spoolfetch(self, arg):
         """
         Handles command "spoolfetch"
         """
-        LOG.debug('Command "spellfetch" executed with args: %r' % arg)
+        LOG.debug('Command "spellfetch" executed with args: %r', arg)
+        if self.spool is not None:
+            try:
+                since = int(arg)
+            except ValueError:
+                self.put_fun('# Invalid timestamp: %r\n' % arg)
+                self.put_fun('.\n')
+                return
+            self.spool.fetch(since, self.put_fun)
+            self.put_fun('.\n')
+            return
+
         output = Popen(['%s/spoolfetch_%s' % (self.options.spoolfetch_dir,
             self.options.host),
-            arg]).communicate()[0]
+            arg], stdout=PIPE).communicate()[0]
         self.put_fun(output)
         self.put_fun('.\n')
 
@@ -176,8 +563,8 @@ class CmdHandler(object):
         cmd = line[0]
         if len(line) == 1:
             arg = ''
-        elif len(line) == 2:
-            arg = line[1]
+        elif len(line) == 2 or cmd in VARIADIC_COMMANDS:
+            arg = ' '.join(line[1:])
         else:
             self.put_fun('# Invalid input: %s\n' % line)
             return
@@ -193,13 +580,9 @@ class CmdHandler(object):
                 commands))
             return
 
+        start = time()
         func(arg)
-
-    def is_timed_out(self):
-        return (datetime.now() - self._last_command).seconds > SESSION_TIMEOUT
-
-    def reset_time(self):
-        self._last_command = datetime.now()
+        self.stats.observe('command', cmd, time() - start)
 
 
 def usage(option, opt, value, parser):
@@ -210,6 +593,20 @@ def usage(option, opt, value, parser):
     sys.exit(0)
 
 
+def parse_plugin_values(parser, option, values):
+    """
+    Converts a list of ``PLUGIN=SECONDS`` values into a dictionary.
+    """
+    result = {}
+    for value in values:
+        try:
+            plugin, seconds = value.split('=', 1)
+            result[plugin] = float(seconds)
+        except ValueError:
+            parser.error('Invalid %s value: %r' % (option, value))
+    return result
+
+
 def get_options():
     """
     Parses command-line arguments.
@@ -222,6 +619,10 @@ def get_options():
             default='plugins',
             help=('The directory containing the munin-plugins.'
                 ' Default: <current working dir>/plugins'))
+    parser.add_option('-c', '--plugin-conf-dir', dest='plugin_conf_dir',
+            default=None,
+            help=('A munin plugin-conf.d directory with the environment, '
+                'user, group and timeout of the plugins. Default: disabled'))
     parser.add_option('-h', '--host', dest='host',
             help=('The hostname which will be reported in the plugins.'
                 ' Default: %s' % socket.gethostname()),
@@ -234,65 +635,350 @@ def get_options():
     parser.add_option('-l', '--log-dir', dest='log_dir',
             default=None,
             help='The log folder. Default: disabled')
+    parser.add_option('--log-level', dest='log_level',
+            default='debug',
+            type='choice',
+            choices=['debug', 'info', 'warning', 'error'],
+            help='The lowest level written to the log folder. '
+               'Default: debug')
+    parser.add_option('--log-debug-sample', dest='log_debug_sample',
+            default=1.0,
+            type='float',
+            metavar='RATE',
+            help='Only log this fraction (0 to 1) of the debug messages. '
+               'Default: 1 (all of them)')
     parser.add_option('-s', '--spoolfech-dir', dest='spoolfetch_dir',
             default=None,
             help='The spoolfetch folder. Default: disabled')
+    parser.add_option('--spool-interval', dest='spool_interval',
+            default=0,
+            type='int',
+            help='Collect results of all plugins every SPOOL_INTERVAL '
+               'seconds into the spoolfetch folder and answer "spoolfetch" '
+               'from there. Default: 0 (use an external spoolfetch script)')
+    parser.add_option('-e', '--event-loop', dest='event_loop',
+            default=False,
+            action='store_true',
+            help='Serve all socket connections from one event loop. This '
+               'handles many concurrent sessions instead of one at a time.')
+    parser.add_option('-P', '--processes', dest='processes',
+            default=0,
+            type='int',
+            help='Serve connections from this many pre-forked processes '
+               'sharing the port. Dead processes are restarted. '
+               'Default: 0 (serve from a single process)')
+    parser.add_option('-w', '--plugin-workers', dest='plugin_workers',
+            default=0,
+            type='int',
+            help='Run plugins in a pool of this many worker threads. Fetches '
+               'for all plugins are started as soon as a master connects, '
+               'and pipelined config/fetch commands are started together. '
+               'Default: 0 (run plugins one after the other)')
+    parser.add_option('-t', '--timeout', dest='timeout',
+            default=0,
+            type='float',
+            help='Kill plugins (including all processes they started) '
+               'which run longer than this many seconds. Default: 0 (never)')
+    parser.add_option('--plugin-timeout', dest='plugin_timeout',
+            default=[],
+            action='append',
+            metavar='PLUGIN=SECONDS',
+            help='Overrides the timeout for one plugin. May be given '
+               'multiple times. A timeout of 0 disables it for the plugin.')
+    parser.add_option('--max-plugin-output', dest='max_plugin_output',
+            default=MAX_OUTPUT,
+            type='int',
+            metavar='BYTES',
+            help='Kill plugins writing more than this many bytes and end '
+               'their response early. Default: %d (0 disables the '
+               'limit)' % MAX_OUTPUT)
+    parser.add_option('--warm-python', dest='warm_python',
+            default=False,
+            action='store_true',
+            help='Run python plugins in long-lived worker processes instead '
+               'of starting a new interpreter for every run.')
+    parser.add_option('--prefetch', dest='prefetch',
+            default=False,
+            action='store_true',
+            help='Learn when masters poll and fetch their plugins shortly '
+               'before the next expected poll.')
+    parser.add_option('--prefetch-lead', dest='prefetch_lead',
+            default=15,
+            type='float',
+            help='Start pre-fetching this many seconds before the expected '
+               'poll. Default: 15')
+    parser.add_option('--prefetch-max-age', dest='prefetch_max_age',
+            default=30,
+            type='float',
+            help='Never answer with pre-fetched values older than this many '
+               'seconds. Default: 30')
+    parser.add_option('--cache-ttl', dest='cache_ttl',
+            default=0,
+            type='float',
+            help='Cache plugin output for this many seconds and share it '
+               'between sessions. Default: 0 (disabled)')
+    parser.add_option('--cache-ttl-for', dest='cache_ttl_for',
+            default=[],
+            action='append',
+            metavar='PLUGIN=SECONDS',
+            help='Overrides the cache TTL for one plugin. May be given '
+               'multiple times. A TTL of 0 disables caching for the plugin.')
+    parser.add_option('--cache-size', dest='cache_size',
+            default=1024,
+            type='int',
+            help='The maximum number of cached plugin results. The least '
+               'recently used results are dropped first. Default: 1024')
     parser.add_option('--help', action='callback', callback=usage,
             help='Shows this help')
 
     options, args = parser.parse_args()
 
+    options.cache_ttls = parse_plugin_values(parser, '--cache-ttl-for',
+        options.cache_ttl_for)
+    options.plugin_timeouts = parse_plugin_values(parser, '--plugin-timeout',
+        options.plugin_timeout)
+
     # ensure we are using absolute paths (for daemonizing)
     if options.log_dir:
         options.log_dir = abspath(options.log_dir)
 
     if options.spoolfetch_dir:
         options.spoolfetch_dir = abspath(options.spoolfetch_dir)
+    elif options.spool_interval:
+        parser.error('--spool-interval requires a spoolfetch folder (-s)')
 
     if options.plugin_dir:
         options.plugin_dir = abspath(options.plugin_dir)
 
+    if options.plugin_conf_dir:
+        options.plugin_conf_dir = abspath(options.plugin_conf_dir)
+
+    if not 0 <= options.log_debug_sample <= 1:
+        parser.error('--log-debug-sample must be between 0 and 1')
+
+    if options.prefetch and options.prefetch_max_age <= options.prefetch_lead:
+        parser.error('--prefetch-max-age must be larger than --prefetch-lead')
+
     return (options, args)
 
 
+def create_executor(options, stats=None):
+    """
+    Returns the plugin executor pool requested on the command-line, or
+    ``None`` if plugins should run inline.
+    """
+    if not options.plugin_workers:
+        return None
+    LOG.info('Starting %d plugin workers', options.plugin_workers)
+    return ExecutorPool(options.plugin_workers, stats)
+
+
+def create_cache(options):
+    """
+    Returns the result cache requested on the command-line, or ``None`` if
+    caching is disabled.
+    """
+    if not (options.cache_ttl or options.cache_ttls):
+        return None
+    return ResultCache(options.cache_ttl, options.cache_ttls,
+        options.cache_size)
+
+
+def create_spool(options, runner, index, stats, collect=True):
+    """
+    Returns the native result spool and starts its collector if requested
+    on the command-line. Returns ``None`` otherwise.
+
+    :param collect: Whether this process fills the spool. Otherwise it only
+        reads what another process collected.
+    """
+    if not (options.spoolfetch_dir and options.spool_interval):
+        return None
+    if not collect:
+        return Spool(options.spoolfetch_dir, shared=True)
+    spool = Spool(options.spoolfetch_dir)
+    # The collector uses its own handler so it never sees cached output.
+    collector_handler = CmdHandler(None, None, options, runner=runner,
+        index=index, stats=stats)
+    collector = SpoolCollector(spool, collector_handler.list_plugins,
+        collector_handler.run_plugin, options.spool_interval)
+    collector.start()
+    LOG.info('Spooling results every %d seconds into %s',
+        options.spool_interval, options.spoolfetch_dir)
+    return spool
+
+
+def create_prefetch(options, runner, index, stats, executor):
+    """
+    Returns the started pre-fetch scheduler if requested on the
+    command-line, or ``None``.
+    """
+    if not options.prefetch:
+        return None
+    # Like the spool collector, the scheduler uses a handler of its own.
+    prefetch_handler = CmdHandler(None, None, options, runner=runner,
+        index=index, stats=stats)
+    prefetch = PrefetchScheduler(prefetch_handler.run_plugin,
+        options.prefetch_lead, options.prefetch_max_age, executor)
+    prefetch.start()
+    LOG.info('Pre-fetching %s seconds before the expected polls',
+        options.prefetch_lead)
+    return prefetch
+
+
+def register_stats_sources(stats, runner, index, cache, python_pool,
+        prefetch=None):
+    """
+    Adds the counters kept by the shared components to the JSON dump of
+    ``stats``.
+    """
+    stats.add_source('timeouts', lambda: dict(runner.timeout_counts))
+    stats.add_source('index', lambda: {'scans': index.scans})
+    if cache is not None:
+        stats.add_source('cache', lambda: {
+            'entries': len(cache),
+            'hits': cache.hits,
+            'misses': cache.misses,
+            'evictions': cache.evictions,
+            })
+    if python_pool is not None:
+        stats.add_source('python_pool',
+            lambda: {'restarts': python_pool.restarts})
+    if prefetch is not None:
+        stats.add_source('prefetch', lambda: {
+            'runs': prefetch.runs,
+            'hits': prefetch.staged.hits,
+            'misses': prefetch.staged.misses,
+            })
+
+
+def stats_filename(options):
+    """
+    Returns the file receiving the statistics dump: ``pypmmn-stats.json``
+    inside the log folder, or the temporary folder without one.
+    """
+    return join(options.log_dir or tempfile.gettempdir(), 'pypmmn-stats.json')
+
+
+def install_stats_dump(options, stats):
+    """
+    Writes the statistics as JSON into :py:func:`stats_filename` on
+    ``SIGUSR1``.
+    """
+    filename = stats_filename(options)
+
+    def dump(signum, frame):
+        try:
+            fptr = open(filename, 'w')
+            try:
+                fptr.write(stats.to_json())
+            finally:
+                fptr.close()
+        except IOError, exc:
+            LOG.warning('Unable to write statistics: %s', exc)
+            return
+        LOG.info('Statistics written to %s', filename)
+
+    signal.signal(signal.SIGUSR1, dump)
+
+
+def make_handler_factory(options, stats=None, collect_spool=True):
+    """
+    Creates the components shared by all sessions and returns a function
+    creating a new :py:class:`CmdHandler` from a ``get_fun`` and a
+    ``put_fun``.
+
+    This must be called after daemonizing, as it may start threads.
+
+    :param stats: The :py:class:`stats.Stats` to record into. By default, a
+        new one is created and dumped on ``SIGUSR1``.
+    :param collect_spool: Whether this process runs the spool collector
+    """
+    if stats is None:
+        stats = Stats()
+        install_stats_dump(options, stats)
+    python_pool = None
+    if options.warm_python:
+        python_pool = WarmPythonPool()
+    plugin_config = None
+    if options.plugin_conf_dir:
+        plugin_config = PluginConfigStore(options.plugin_conf_dir)
+    runner = PluginRunner(options.timeout, options.plugin_timeouts,
+        python_pool, stats, plugin_config, options.max_plugin_output)
+    index = PluginIndex(options.plugin_dir)
+    executor = create_executor(options, stats)
+    cache = create_cache(options)
+    spool = create_spool(options, runner, index, stats, collect_spool)
+    prefetch = create_prefetch(options, runner, index, stats, executor)
+    register_stats_sources(stats, runner, index, cache, python_pool,
+        prefetch)
+
+    def handler_factory(get_fun, put_fun):
+        return CmdHandler(get_fun, put_fun, options, executor, cache, spool,
+            runner, index, stats, prefetch)
+    return handler_factory
+
+
+def add_log_handler(options, handler):
+    """
+    Adds ``handler`` to the root logger. Records are written by a background
+    thread (see :py:mod:`asynclog`), so logging does not block the commands.
+    Debug records are sampled if requested on the command-line.
+    """
+    handler.setFormatter(logging.Formatter(LOG_FORMAT))
+    async_handler = AsyncHandler([handler])
+    if options.log_debug_sample < 1:
+        async_handler.addFilter(DebugSampler(options.log_debug_sample))
+    logging.getLogger().addHandler(async_handler)
+
+
 def process_stdin(options):
     """
     Process commands by reading from stdin
     """
+    log_dir = options.log_dir or join(abspath(dirname(__file__)), 'log')
     rfhandler = RotatingFileHandler(
-        join(abspath(dirname(__file__)), 'log', 'pypmmn.log'),
+        join(log_dir, 'pypmmn.log'),
         maxBytes=100 * 1024,
         backupCount=5
         )
-    rfhandler.setFormatter(logging.Formatter(LOG_FORMAT))
-    logging.getLogger().addHandler(rfhandler)
-    handler = CmdHandler(sys.stdin.read, sys.stdout.write, options)
+    add_log_handler(options, rfhandler)
+    def send(data):
+        sys.stdout.write(data)
+        sys.stdout.flush()
+
+    output = OutputBuffer(send)
+    handler = make_handler_factory(options)(sys.stdin.read, output.write)
     handler.do_version(None)
+    handler.start_session()
+    output.flush()
     LOG.info('STDIN handler opened')
     while True:
-        data = sys.stdin.readline().strip()
+        try:
+            data = sys.stdin.readline().strip()
+        except IOError, exc:
+            # interrupted by a signal (for example the statistics dump)
+            if exc.errno == EINTR:
+                continue
+            raise
         if not data:
             return
         handler.handle_input(data)
+        output.flush()
 
 
-def process_socket(options):
+def prepare_daemon(options):
     """
-    Process socket connections.
-
-    .. note::
+    Sets up logging for the socket handlers and daemonizes the process
+    unless running in the foreground.
 
-        This is not a multithreaded process. So only one connection can be
-        handled at any given time. But given the nature of munin, this is Good
-        Enough.
+    Returns the return code of the daemonization.
     """
-
     retcode = 0
     if options.no_daemon:
         # set up on-screen-logging
         console_handler = logging.StreamHandler(sys.stdout)
-        console_handler.setFormatter(logging.Formatter(LOG_FORMAT))
-        logging.getLogger().addHandler(console_handler)
+        add_log_handler(options, console_handler)
     else:
         # fork fork
         retcode = createDaemon()
@@ -303,83 +989,203 @@ def process_socket(options):
             maxBytes=100 * 1024,
             backupCount=5
             )
-        rfhandler.setFormatter(logging.Formatter(LOG_FORMAT))
-        logging.getLogger().addHandler(rfhandler)
+        add_log_handler(options, rfhandler)
 
         # write down some house-keeping information
-        LOG.info('New process PID: %d' % getpid())
+        LOG.info('New process PID: %d', getpid())
         pidfile = open(join(options.log_dir, 'pypmmn.pid'), 'w')
         pidfile.write(str(getpid()))
         pidfile.close()
-        LOG.info('PID file created in %s' % join(options.log_dir,
+        LOG.info('PID file created in %s', join(options.log_dir,
             'pypmmn.pid'))
+    return retcode
 
-    LOG.info('Socket handler started.')
 
+def create_listener(options, backlog=1, reuse_port=False):
+    """
+    Creates the listening TCP socket for ``options.port``.
+
+    :param reuse_port: Set ``SO_REUSEPORT``, so other processes can listen on
+        the same port
+    """
     host = '' # listens on all addresses TODO: make this configurable
     port = int(options.port)
 
     s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
     s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    if reuse_port:
+        s.setsockopt(socket.SOL_SOCKET, SO_REUSEPORT, 1)
     s.bind((host, port))
-    s.listen(1)
+    s.listen(backlog)
 
-    LOG.info('Listening on host %r, port %r' % (host, port))
+    LOG.info('Listening on host %r, port %r', host, port)
+    return s
 
-    conn, addr = s.accept()
-    handler = CmdHandler(conn.recv, conn.send, options)
-    handler.do_version(None)
-    handler.reset_time()
 
-    LOG.info("Accepting incoming connection from %s" % (addr, ))
+def process_socket(options):
+    """
+    Process socket connections.
+
+    .. note::
+
+        This is not a multithreaded process. So only one connection can be
+        handled at any given time. But given the nature of munin, this is Good
+        Enough. Use :py:func:`process_socket_evented` if you need to handle
+        more than one master at a time.
+    """
+
+    retcode = prepare_daemon(options)
+
+    LOG.info('Socket handler started.')
+
+    serve_blocking(create_listener(options), make_handler_factory(options))
+
+    sys.exit(retcode)
+
+
+def serve_blocking(listener, handler_factory):
+    """
+    Accepts connections on ``listener`` and serves them one after the other.
+    """
+    handler = handler_factory(None, None)
+
     while True:
-        data = conn.recv(1024)
-        if not data.strip():
-            sleep(1)
-            if handler.is_timed_out():
-                LOG.info('Session timeout.')
-                conn.shutdown(socket.SHUT_RDWR)
-                conn.close()
-
-                LOG.info('Listening on host %r, port %r' % (host, port))
-
-                conn, addr = s.accept()
-                handler.reset_time()
-                handler.get_fun = conn.recv
-                handler.put_fun = conn.send
-                handler.do_version(None)
-
-                LOG.info("Accepting incoming connection from %s" % (addr, ))
-            try:
-                data = conn.recv(1024)
-            except socket.error, exc:
-                LOG.warning("Socket error. Reinitialising.: %s" % exc)
-                conn, addr = s.accept()
-                handler.reset_time()
-                handler.get_fun = conn.recv
-                handler.put_fun = conn.send
-                handler.do_version(None)
-
-                LOG.info("Accepting incoming connection from %s" % (addr, ))
-
-        if data.strip() == 'quit':
-            LOG.info('Client requested session end. Closing connection.')
-            conn.shutdown(socket.SHUT_RDWR)
-            conn.close()
+        try:
+            conn, addr = listener.accept()
+        except socket.error, exc:
+            # interrupted by a signal (for example the statistics dump)
+            if exc.args[0] == EINTR:
+                continue
+            raise
+        LOG.info("Accepting incoming connection from %s", addr)
+        serve_connection(conn, handler)
+
 
-            LOG.info('Listening on host %r, port %r' % (host, port))
+def serve_connection(conn, handler):
+    """
+    Serves one munin master on the connected socket ``conn`` until it quits,
+    disconnects or stays idle for longer than :py:data:`SESSION_TIMEOUT`.
 
-            conn, addr = s.accept()
-            handler.reset_time()
-            handler.get_fun = conn.recv
-            handler.put_fun = conn.send
+    Several commands may arrive at once (pipelining). They are executed one
+    after the other and their output is sent in as few writes as possible.
+    """
+    output = OutputBuffer(conn.sendall)
+    try:
+        peer = conn.getpeername()[0]
+    except socket.error:
+        peer = None
+    handler.get_fun = conn.recv
+    handler.put_fun = output.write
+    reader = LineBuffer()
+    conn.settimeout(SESSION_TIMEOUT)
+
+    try:
+        try:
             handler.do_version(None)
+            handler.start_session(peer)
+            output.flush()
+            while True:
+                try:
+                    data = conn.recv(RECV_SIZE)
+                except socket.timeout:
+                    LOG.info('Session timeout.')
+                    return
+                except socket.error, exc:
+                    if exc.args[0] == EINTR:
+                        continue
+                    raise
+                if not data:
+                    LOG.info('Connection closed by client.')
+                    return
+                try:
+                    lines = reader.feed(data)
+                except LineTooLong, exc:
+                    LOG.warning('Closing connection: %s', exc)
+                    output.write('# %s\n' % exc)
+                    output.flush()
+                    return
+                if len(lines) > 1:
+                    handler.speculate_lines(lines)
+                for line in lines:
+                    if line.strip() in ('quit', 'exit'):
+                        LOG.info('Client requested session end. '
+                            'Closing connection.')
+                        output.flush()
+                        return
+                    handler.handle_input(line)
+                output.flush()
+        except socket.error, exc:
+            LOG.warning("Socket error: %s", exc)
+    finally:
+        handler.end_session()
+        try:
+            conn.shutdown(socket.SHUT_RDWR)
+        except socket.error:
+            pass
+        conn.close()
 
-            LOG.info("Accepting incoming connection from %s" % (addr, ))
 
-            continue
+def process_socket_evented(options):
+    """
+    Process socket connections using an event loop.
 
-        handler.handle_input(data)
+    Every connection gets its own session with an idle timeout driven by the
+    loop's timers. Commands of one session are executed in order, while
+    sessions run concurrently.
+    """
+    retcode = prepare_daemon(options)
+    LOG.info('Event loop socket handler started.')
+
+    serve_evented(create_listener(options, socket.SOMAXCONN),
+        make_handler_factory(options))
+
+    sys.exit(retcode)
+
+
+def serve_evented(listener, handler_factory):
+    """
+    Serves all connections accepted on ``listener`` from one event loop.
+    """
+    loop = EventLoop()
+    Server(loop, listener,
+        lambda put_fun: handler_factory(None, put_fun), SESSION_TIMEOUT)
+    try:
+        loop.run_forever()
+    except KeyboardInterrupt:
+        LOG.info('Interrupted. Shutting down.')
+
+
+def process_socket_prefork(options):
+    """
+    Process socket connections in ``options.processes`` pre-forked worker
+    processes (see :py:mod:`prefork`). Each worker serves its connections
+    one at a time, or from an event loop if ``options.event_loop`` is set.
+
+    Only the first worker runs the spool collector.
+    """
+    retcode = prepare_daemon(options)
+    LOG.info('Pre-fork socket handler started with %d processes.',
+        options.processes)
+
+    shared_listener = None
+    if not reuse_port_supported():
+        LOG.warning('SO_REUSEPORT is not supported. The processes share '
+            'one listening socket.')
+        shared_listener = create_listener(options, socket.SOMAXCONN)
+
+    def worker(number, stats):
+        listener = shared_listener
+        if listener is None:
+            listener = create_listener(options, socket.SOMAXCONN,
+                reuse_port=True)
+        handler_factory = make_handler_factory(options, stats,
+            collect_spool=(number == 0))
+        if options.event_loop:
+            serve_evented(listener, handler_factory)
+        else:
+            serve_blocking(listener, handler_factory)
+
+    Supervisor(options.processes, worker, stats_filename(options)).run()
 
     sys.exit(retcode)
 
@@ -397,12 +1203,16 @@ def main():
                 options.log_dir))
         # set up logging if requested
         root_logger = logging.getLogger()
-        root_logger.setLevel(logging.NOTSET)  # TODO: Make configurable
+        root_logger.setLevel(getattr(logging, options.log_level.upper()))
 
     # Start either the "stdin" interface, or the socked daemon. Depending on
     # whether a port was given on startup or not.
     if not options.port:
         process_stdin(options)
+    elif options.processes:
+        process_socket_prefork(options)
+    elif options.event_loop:
+        process_socket_evented(options)
     else:
         process_socket(options)
 
@@ -0,0 +1,273 @@
+"""
+Execution of plugin processes with hard deadlines.
+
+Every plugin is started in its own process group. If it does not finish in
+time, the whole group is killed, so forked helpers of the plugin cannot keep
+the node busy either.
+
+The output is passed on in chunks as the plugin writes it. While the master
+does not take the data, no more of it is read from the plugin, so the plugin
+blocks on its full pipe instead of the node buffering everything.
+"""
+from errno import EFBIG, EINTR, EINVAL, ETIME
+from os.path import basename
+from subprocess import Popen, PIPE
+from time import time, sleep
+import logging
+import os
+import select
+import signal
+import threading
+
+LOG = logging.getLogger(__name__)
+
+#: Size of the reads from a plugin's stdout
+READ_SIZE = 65536
+
+#: Default limit of the output of one plugin run (in bytes)
+MAX_OUTPUT = 64 * 1024 * 1024
+
+
+class PluginTimeout(OSError):
+    """
+    Raised when a plugin did not finish before its deadline.
+    """
+
+    def __init__(self, plugin, timeout):
+        OSError.__init__(self, ETIME,
+            'Plugin %s timed out after %s seconds' % (plugin, timeout))
+        self.plugin = plugin
+        self.timeout = timeout
+
+
+class OutputTooLarge(OSError):
+    """
+    Raised when a plugin wrote more than the allowed amount of output.
+    """
+
+    def __init__(self, plugin, limit):
+        OSError.__init__(self, EFBIG,
+            'Plugin %s wrote more than %d bytes' % (plugin, limit))
+        self.plugin = plugin
+        self.limit = limit
+
+
+def kill_group(pid):
+    """
+    Kills the process group led by ``pid``.
+    """
+    try:
+        os.killpg(pid, signal.SIGKILL)
+    except OSError:
+        pass
+
+
+def wait_readable(fd, timeout):
+    """
+    Waits up to ``timeout`` seconds for ``fd`` to become readable. Returns
+    ``True`` if it did. Uses ``poll`` where available, as ``select`` cannot
+    handle the high descriptor numbers of a busy event loop.
+    """
+    try:
+        if hasattr(select, 'poll'):
+            poller = select.poll()
+            poller.register(fd, select.POLLIN | select.POLLPRI)
+            return bool(poller.poll(timeout * 1000))
+        return bool(select.select([fd], [], [], timeout)[0])
+    except select.error, exc:
+        if exc.args[0] == EINTR:
+            return False
+        raise
+
+
+def stream_process(args, sink, timeout=None, env=None, credentials=None,
+        max_output=0):
+    """
+    Runs ``args`` in a new process group and passes its output to ``sink``
+    in chunks as it arrives. ``sink`` may block, the process then blocks as
+    soon as its pipe is full.
+
+    :param timeout: Seconds after which the process group is killed. ``None``
+        or ``0`` waits forever.
+    :param env: The environment of the process. ``None`` inherits ours.
+    :param credentials: An optional ``(uid, gid, groups)`` tuple to run the
+        process with. Each item may be ``None`` to keep ours.
+    :param max_output: The process group is killed once it wrote more than
+        this many bytes. ``0`` allows any amount.
+    :raises PluginTimeout: if the deadline was hit
+    :raises OutputTooLarge: if the process wrote too much. The output up to
+        the limit was passed to ``sink``.
+    """
+    def preexec():
+        os.setsid()
+        if credentials is not None:
+            uid, gid, groups = credentials
+            if groups is not None:
+                os.setgroups(groups)
+            if gid is not None:
+                os.setgid(gid)
+            if uid is not None:
+                os.setuid(uid)
+
+    proc = Popen(args, stdout=PIPE, close_fds=True, preexec_fn=preexec,
+        env=env)
+    deadline = timeout and time() + timeout
+    fd = proc.stdout.fileno()
+    size = 0
+    try:
+        while True:
+            if deadline:
+                remaining = deadline - time()
+                if remaining <= 0:
+                    raise PluginTimeout(basename(args[0]), timeout)
+                if not wait_readable(fd, remaining):
+                    continue
+            try:
+                data = os.read(fd, READ_SIZE)
+            except OSError, exc:
+                if exc.errno == EINTR:
+                    continue
+                raise
+            if not data:
+                break
+            size += len(data)
+            if max_output and size > max_output:
+                sink(data[:len(data) - (size - max_output)])
+                raise OutputTooLarge(basename(args[0]), max_output)
+            sink(data)
+
+        # stdout is closed, but the process may still be running
+        if not deadline:
+            proc.wait()
+        while proc.poll() is None:
+            if time() >= deadline:
+                raise PluginTimeout(basename(args[0]), timeout)
+            sleep(0.01)
+    except:
+        kill_group(proc.pid)
+        proc.stdout.close()
+        proc.wait()
+        raise
+    proc.stdout.close()
+
+
+def run_process(args, timeout=None, env=None, credentials=None,
+        max_output=0):
+    """
+    Runs ``args`` in a new process group and returns its output. See
+    :py:func:`stream_process` for the parameters.
+    """
+    chunks = []
+    stream_process(args, chunks.append, timeout, env, credentials,
+        max_output)
+    return ''.join(chunks)
+
+
+class PluginRunner(object):
+    """
+    Runs plugins, either as external processes or in a warm python worker,
+    and enforces their deadlines.
+
+    :param default_timeout: Deadline in seconds for plugins without a
+        specific timeout. ``0`` disables the deadline.
+    :param timeouts: A dictionary mapping plugin names to deadlines
+    :param python_pool: An optional :py:class:`warm.WarmPythonPool`
+    :param stats: An optional :py:class:`stats.Stats` counting forks, warm
+        runs and timeouts
+    :param plugin_config: An optional :py:class:`pluginconf.PluginConfigStore`
+        providing the environment, credentials and timeout of each plugin
+    :param max_output: The largest output (in bytes) accepted from one plugin
+        run. ``0`` allows any amount.
+    """
+
+    def __init__(self, default_timeout=0, timeouts=None, python_pool=None,
+            stats=None, plugin_config=None, max_output=MAX_OUTPUT):
+        self.default_timeout = default_timeout
+        self.max_output = max_output
+        self.timeouts = timeouts or {}
+        self.python_pool = python_pool
+        self.stats = stats
+        self.plugin_config = plugin_config
+        #: Number of timeouts per plugin
+        self.timeout_counts = {}
+        self._lock = threading.Lock()
+
+    def timeout(self, plugin, config=None):
+        """
+        Returns the deadline in seconds for ``plugin``. Timeouts given per
+        plugin on the command-line win over the ``timeout`` setting of the
+        plugin ``config``, which wins over the default.
+        """
+        if plugin in self.timeouts:
+            return self.timeouts[plugin]
+        if config is not None and config.timeout is not None:
+            return config.timeout
+        return self.default_timeout
+
+    def _count(self, name):
+        if self.stats is not None:
+            self.stats.incr(name)
+
+    def run(self, plugin_filename, plugin_arg):
+        """
+        Runs a plugin with the single argument ``plugin_arg`` and returns
+        its output.
+
+        :raises PluginTimeout: if the plugin was killed
+        :raises OutputTooLarge: if the plugin wrote more than ``max_output``
+            bytes
+        :raises OSError: if the plugin could not be executed
+        """
+        chunks = []
+        self.stream(plugin_filename, plugin_arg, chunks.append)
+        return ''.join(chunks)
+
+    def stream(self, plugin_filename, plugin_arg, sink):
+        """
+        Runs a plugin like :py:meth:`run`, but passes its output to ``sink``
+        in chunks as it arrives. Plugins in warm python workers pass all of
+        their output at once.
+        """
+        plugin = basename(plugin_filename)
+        env = credentials = config = None
+        if self.plugin_config is not None:
+            config = self.plugin_config.get(plugin)
+            if config.error:
+                raise OSError(EINVAL, config.error)
+            env = config.env
+            credentials = config.credentials()
+        timeout = self.timeout(plugin, config)
+        try:
+            if self.python_pool is not None:
+                interpreter = self.python_pool.interpreter(plugin_filename)
+                if interpreter:
+                    LOG.debug('Executing %r in a warm python worker',
+                        [plugin_filename, plugin_arg])
+                    self._count('warm_runs')
+                    output = self.python_pool.run(plugin_filename,
+                        interpreter, [plugin_arg], env, timeout, credentials)
+                    if self.max_output and len(output) > self.max_output:
+                        sink(output[:self.max_output])
+                        raise OutputTooLarge(plugin, self.max_output)
+                    sink(output)
+                    return
+
+            cmd = [plugin_filename, plugin_arg]
+            LOG.debug('Executing %r', cmd)
+            self._count('forks')
+            stream_process(cmd, sink, timeout, env, credentials,
+                self.max_output)
+        except OutputTooLarge, exc:
+            self._count('oversized')
+            LOG.warning('%s, killed it', exc.strerror)
+            raise
+        except PluginTimeout, exc:
+            self._lock.acquire()
+            try:
+                count = self.timeout_counts.get(plugin, 0) + 1
+                self.timeout_counts[plugin] = count
+            finally:
+                self._lock.release()
+            self._count('timeouts')
+            LOG.warning('%s (%d timeouts so far)', exc.strerror, count)
+            raise
@@ -0,0 +1,286 @@
+"""
+Native result spooling for the ``spoolfetch`` command.
+
+A background collector runs ``config`` and ``fetch`` for every plugin on the
+munin interval and appends the timestamped results to an on-disk ring buffer.
+The buffer consists of append-only segment files. Next to each segment, an
+index file holds one fixed-size ``(timestamp, start, end)`` record per
+collection run, so ``spoolfetch <timestamp>`` can binary-search its starting
+point instead of scanning the data.
+"""
+from bisect import bisect_right
+from os import listdir, remove, fstat
+from os.path import join, exists, getsize
+from time import time, sleep
+import logging
+import re
+import struct
+import threading
+
+LOG = logging.getLogger(__name__)
+
+#: Default collection interval in seconds (the munin update interval)
+DEFAULT_INTERVAL = 300
+#: Segments are rotated once they grow beyond this many bytes
+SEGMENT_SIZE = 1024 * 1024
+#: The number of segments kept on disk. Older ones are removed.
+MAX_SEGMENTS = 64
+#: Number of bytes handed to the output function at once
+CHUNK_SIZE = 64 * 1024
+
+INDEX_RECORD = struct.Struct('!QQQ')
+SEGMENT_PREFIX = 'spool-'
+SEGMENT_SUFFIX = '.seg'
+INDEX_SUFFIX = '.idx'
+
+VALUE_LINE = re.compile(r'^(\S+\.value)\s+(\S+)\s*$')
+
+
+def format_record(plugin, timestamp, config, fetch):
+    """
+    Converts the output of one plugin run into the ``spoolfetch`` format:
+    A ``multigraph`` header (unless the plugin is a multigraph plugin
+    itself), the config and the values prefixed with ``timestamp``.
+    """
+    lines = []
+    first = config.lstrip().split('\n', 1)[0]
+    if not first.startswith('multigraph '):
+        lines.append('multigraph %s' % plugin)
+    lines.extend(line for line in config.splitlines() if line.strip())
+    for line in fetch.splitlines():
+        match = VALUE_LINE.match(line)
+        if match and ':' not in match.group(2):
+            line = '%s %d:%s' % (match.group(1), timestamp, match.group(2))
+        if line.strip():
+            lines.append(line)
+    return '\n'.join(lines) + '\n'
+
+
+class Segment(object):
+    """
+    One data file of the ring buffer together with its index.
+    """
+
+    def __init__(self, spool_dir, start):
+        self.start = start
+        name = '%s%010d' % (SEGMENT_PREFIX, start)
+        self.data_path = join(spool_dir, name + SEGMENT_SUFFIX)
+        self.index_path = join(spool_dir, name + INDEX_SUFFIX)
+
+    def size(self):
+        """
+        Returns the size of the data file in bytes.
+        """
+        if not exists(self.data_path):
+            return 0
+        return getsize(self.data_path)
+
+    def append(self, timestamp, data):
+        """
+        Appends the data of one collection run. The index record is only
+        written once the data is on disk, so readers never see partial runs.
+        """
+        fptr = open(self.data_path, 'ab')
+        try:
+            fptr.seek(0, 2)
+            start = fptr.tell()
+            fptr.write(data)
+            fptr.flush()
+            end = fptr.tell()
+        finally:
+            fptr.close()
+        fptr = open(self.index_path, 'ab')
+        try:
+            fptr.write(INDEX_RECORD.pack(timestamp, start, end))
+        finally:
+            fptr.close()
+
+    def find(self, since):
+        """
+        Returns the ``(start, end)`` byte range of all runs newer than
+        ``since``, or ``None`` if there are none.
+        """
+        if not exists(self.index_path):
+            return None
+        fptr = open(self.index_path, 'rb')
+        try:
+            count = fstat(fptr.fileno()).st_size // INDEX_RECORD.size
+            if not count:
+                return None
+
+            def record(i):
+                fptr.seek(i * INDEX_RECORD.size)
+                return INDEX_RECORD.unpack(fptr.read(INDEX_RECORD.size))
+
+            low, high = 0, count
+            while low < high:
+                mid = (low + high) // 2
+                if record(mid)[0] <= since:
+                    low = mid + 1
+                else:
+                    high = mid
+            if low == count:
+                return None
+            return record(low)[1], record(count - 1)[2]
+        finally:
+            fptr.close()
+
+    def read(self, start, end, put_fun):
+        """
+        Sends the bytes between ``start`` and ``end`` using ``put_fun``.
+        """
+        fptr = open(self.data_path, 'rb')
+        try:
+            fptr.seek(start)
+            remaining = end - start
+            while remaining > 0:
+                data = fptr.read(min(CHUNK_SIZE, remaining))
+                if not data:
+                    break
+                remaining -= len(data)
+                put_fun(data)
+        finally:
+            fptr.close()
+
+    def remove(self):
+        """
+        Deletes the segment from disk.
+        """
+        for path in (self.data_path, self.index_path):
+            if exists(path):
+                remove(path)
+
+
+class Spool(object):
+    """
+    The on-disk ring buffer.
+
+    :param spool_dir: The folder holding the segment files
+    :param segment_size: Rotate segments beyond this many bytes
+    :param max_segments: Keep at most this many segments
+    :param shared: Set if another process appends to the spool. The folder
+        is then scanned for new segments on every fetch.
+    """
+
+    def __init__(self, spool_dir, segment_size=SEGMENT_SIZE,
+            max_segments=MAX_SEGMENTS, shared=False):
+        self.spool_dir = spool_dir
+        self.segment_size = segment_size
+        self.max_segments = max_segments
+        self.shared = shared
+        self._lock = threading.Lock()
+        self.segments = self._scan()
+
+    def _scan(self):
+        segments = []
+        for filename in sorted(listdir(self.spool_dir)):
+            if (filename.startswith(SEGMENT_PREFIX) and
+                    filename.endswith(SEGMENT_SUFFIX)):
+                start = filename[len(SEGMENT_PREFIX):-len(SEGMENT_SUFFIX)]
+                if not start.isdigit():
+                    # a backup or a partial copy, not one of ours
+                    LOG.warning('Ignoring %s in the spool folder %s',
+                        filename, self.spool_dir)
+                    continue
+                segments.append(Segment(self.spool_dir, int(start)))
+        return segments
+
+    def append(self, timestamp, data):
+        """
+        Stores the data of one collection run taken at ``timestamp``.
+        """
+        self._lock.acquire()
+        try:
+            if (not self.segments or
+                    self.segments[-1].size() >= self.segment_size):
+                LOG.debug('Starting new spool segment at %d', timestamp)
+                self.segments.append(Segment(self.spool_dir, timestamp))
+            self.segments[-1].append(timestamp, data)
+            while len(self.segments) > self.max_segments:
+                oldest = self.segments.pop(0)
+                LOG.debug('Removing spool segment %s', oldest.data_path)
+                oldest.remove()
+        finally:
+            self._lock.release()
+
+    def fetch(self, since, put_fun):
+        """
+        Sends all data collected after ``since`` using ``put_fun``.
+        """
+        self._lock.acquire()
+        try:
+            if self.shared:
+                self.segments = self._scan()
+            segments = list(self.segments)
+        finally:
+            self._lock.release()
+
+        # The first segment that can contain data newer than ``since`` is
+        # the last one starting at or before it.
+        starts = [segment.start for segment in segments]
+        first = max(bisect_right(starts, since) - 1, 0)
+        for segment in segments[first:]:
+            try:
+                found = segment.find(since)
+                if found:
+                    segment.read(found[0], found[1], put_fun)
+            except (IOError, OSError), exc:
+                # the segment may have been rotated away in the meantime
+                LOG.warning('Unable to read spool segment %s: %s',
+                    segment.data_path, exc)
+
+
+class SpoolCollector(object):
+    """
+    Background thread that fills a :py:class:`Spool` on a fixed interval.
+
+    :param spool: The :py:class:`Spool` to write to
+    :param list_plugins: Callable returning the names of all plugins
+    :param run_plugin: Callable taking a plugin name and a command, returning
+        the plugin output
+    :param interval: The collection interval in seconds
+    """
+
+    def __init__(self, spool, list_plugins, run_plugin,
+            interval=DEFAULT_INTERVAL):
+        self.spool = spool
+        self.list_plugins = list_plugins
+        self.run_plugin = run_plugin
+        self.interval = interval
+        self._thread = None
+
+    def collect(self, timestamp=None):
+        """
+        Runs all plugins once and appends the results to the spool.
+        """
+        if timestamp is None:
+            timestamp = int(time())
+        records = []
+        for plugin in self.list_plugins():
+            try:
+                config = self.run_plugin(plugin, 'config')
+                fetch = self.run_plugin(plugin, 'fetch')
+            except OSError, exc:
+                LOG.warning('Unable to spool %s: %s', plugin, exc)
+                continue
+            records.append(format_record(plugin, timestamp, config, fetch))
+        self.spool.append(timestamp, ''.join(records))
+
+    def _loop(self):
+        while True:
+            # align the runs to the interval, just like munin does
+            now = time()
+            sleep(self.interval - now % self.interval)
+            try:
+                self.collect()
+            except Exception:
+                LOG.exception('Spool collection failed')
+
+    def start(self):
+        """
+        Starts the collector thread.
+        """
+        self._thread = threading.Thread(target=self._loop,
+            name='spool-collector')
+        self._thread.setDaemon(True)
+        self._thread.start()
@@ -0,0 +1,309 @@
+"""
+Self-instrumentation of the node.
+
+:py:class:`Stats` collects execution time histograms per command and per
+plugin, pool queue waits and a few counters. The numbers are available as a
+built-in multigraph plugin (see :py:data:`STATS_PLUGIN`) and as a JSON
+document.
+"""
+from collections import deque
+from time import time
+import json
+import threading
+
+#: Name of the built-in plugin exposing the node's own statistics
+STATS_PLUGIN = 'pypmmn_stats'
+
+#: Upper bounds (in seconds) of the histogram buckets
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+#: Number of recent samples kept per histogram for percentiles
+RECENT_SAMPLES = 512
+
+#: Values merged by taking the maximum instead of the sum
+MAX_MERGED = ('max', 'p50', 'p99', 'uptime')
+
+
+class Histogram(object):
+    """
+    A cumulative bucketed histogram of durations. The most recent samples
+    are kept as well, so percentiles reflect the current behaviour.
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.buckets = [0] * (len(BUCKETS) + 1)
+        self.recent = deque(maxlen=RECENT_SAMPLES)
+
+    def observe(self, value):
+        """
+        Adds one sample (in seconds).
+        """
+        self.count += 1
+        self.total += value
+        self.max = max(self.max, value)
+        for i, bound in enumerate(BUCKETS):
+            if value <= bound:
+                self.buckets[i] += 1
+                break
+        else:
+            self.buckets[-1] += 1
+        self.recent.append(value)
+
+    def percentile(self, fraction):
+        """
+        Returns the given percentile (``0.0`` to ``1.0``) of the recent
+        samples, or ``0`` without samples.
+        """
+        if not self.recent:
+            return 0.0
+        samples = sorted(self.recent)
+        index = min(int(fraction * len(samples)), len(samples) - 1)
+        return samples[index]
+
+    def as_dict(self):
+        """
+        Returns the histogram as JSON serialisable dictionary.
+        """
+        buckets = {}
+        for bound, count in zip(BUCKETS, self.buckets):
+            buckets['le_%s' % bound] = count
+        buckets['le_inf'] = self.buckets[-1]
+        return {
+            'count': self.count,
+            'sum': round(self.total, 6),
+            'max': round(self.max, 6),
+            'p50': round(self.percentile(0.5), 6),
+            'p99': round(self.percentile(0.99), 6),
+            'buckets': buckets,
+            }
+
+
+def field_name(name):
+    """
+    Converts ``name`` into a valid munin field name.
+    """
+    result = []
+    for char in name:
+        if char.isalnum():
+            result.append(char)
+        else:
+            result.append('_')
+    name = ''.join(result)
+    if not name or name[0].isdigit():
+        name = '_' + name
+    return name
+
+
+def _merge(target, source):
+    for key, value in source.items():
+        if isinstance(value, dict):
+            _merge(target.setdefault(key, {}), value)
+        elif key in MAX_MERGED:
+            target[key] = max(target.get(key, 0), value)
+        else:
+            target[key] = target.get(key, 0) + value
+
+
+def merge_snapshots(snapshots):
+    """
+    Merges the :py:meth:`Stats.snapshot` results of several processes.
+    Counters and histogram buckets are added up. Percentiles cannot be
+    merged exactly, the highest one is used instead.
+    """
+    result = {}
+    for snapshot in snapshots:
+        _merge(result, snapshot)
+    return result
+
+
+class Stats(object):
+    """
+    Thread-safe collection of the node's performance numbers.
+    """
+
+    def __init__(self):
+        self.started = time()
+        self._lock = threading.Lock()
+        self._histograms = {}
+        self._counters = {}
+        self._gauges = {}
+        self._sources = []
+        #: The merged snapshot of all processes in pre-fork mode. Published
+        #: by the stats plugin instead of the numbers of this process.
+        self.shared = None
+
+    def observe(self, group, key, seconds):
+        """
+        Records a duration of ``seconds`` for ``key`` in ``group`` (for
+        example ``'plugin'`` and the plugin name).
+        """
+        self._lock.acquire()
+        try:
+            histograms = self._histograms.setdefault(group, {})
+            histogram = histograms.get(key)
+            if histogram is None:
+                histogram = histograms[key] = Histogram()
+            histogram.observe(seconds)
+        finally:
+            self._lock.release()
+
+    def incr(self, name, amount=1):
+        """
+        Increments the counter ``name``.
+        """
+        self._lock.acquire()
+        try:
+            self._counters[name] = self._counters.get(name, 0) + amount
+        finally:
+            self._lock.release()
+
+    def gauge(self, name, delta):
+        """
+        Changes the gauge ``name`` by ``delta``.
+        """
+        self._lock.acquire()
+        try:
+            self._gauges[name] = self._gauges.get(name, 0) + delta
+        finally:
+            self._lock.release()
+
+    def add_source(self, name, fun):
+        """
+        Adds ``fun()`` to the snapshot under ``name``. ``fun`` must return a
+        dictionary of counters.
+        """
+        self._sources.append((name, fun))
+
+    def snapshot(self):
+        """
+        Returns all numbers as JSON serialisable dictionary.
+        """
+        self._lock.acquire()
+        try:
+            result = {
+                'uptime': round(time() - self.started, 3),
+                'counters': dict(self._counters),
+                'gauges': dict(self._gauges),
+                'histograms': {},
+                }
+            for group, histograms in self._histograms.items():
+                result['histograms'][group] = dict(
+                    (key, histogram.as_dict())
+                    for key, histogram in histograms.items())
+        finally:
+            self._lock.release()
+        for name, fun in self._sources:
+            result[name] = fun()
+        return result
+
+    def to_json(self):
+        """
+        Returns :py:meth:`snapshot` as JSON string.
+        """
+        return json.dumps(self.snapshot(), indent=2, sort_keys=True)
+
+    def published(self):
+        """
+        Returns the snapshot published by the stats plugin.
+        """
+        if self.shared is not None:
+            return self.shared
+        return self.snapshot()
+
+    def munin_config(self):
+        """
+        Returns the ``config`` output of the built-in stats plugin.
+        """
+        snapshot = self.published()
+        histograms = snapshot['histograms']
+        lines = []
+
+        for group, title in (('command', 'command'), ('plugin', 'plugin')):
+            if not histograms.get(group):
+                continue
+            lines.extend([
+                'multigraph %s_%s_time' % (STATS_PLUGIN, group),
+                'graph_title pypmmn %s execution time' % title,
+                'graph_vlabel seconds',
+                'graph_category munin',
+                'graph_args --base 1000 -l 0',
+                'graph_info 99th percentile of the %d most recent '
+                    'executions per %s' % (RECENT_SAMPLES, title),
+                ])
+            for key in sorted(histograms.get(group, {})):
+                lines.append('%s.label %s' % (field_name(key), key))
+                lines.append('%s.min 0' % field_name(key))
+
+        lines.extend([
+            'multigraph %s_queue' % STATS_PLUGIN,
+            'graph_title pypmmn worker queue wait',
+            'graph_vlabel seconds',
+            'graph_category munin',
+            'graph_args --base 1000 -l 0',
+            'p50.label median',
+            'p99.label 99th percentile',
+            'multigraph %s_activity' % STATS_PLUGIN,
+            'graph_title pypmmn activity',
+            'graph_vlabel per ${graph_period}',
+            'graph_category munin',
+            'graph_args --base 1000 -l 0',
+            'forks.label forks',
+            'forks.type DERIVE',
+            'forks.min 0',
+            'sessions.label sessions',
+            'sessions.type DERIVE',
+            'sessions.min 0',
+            'timeouts.label plugin timeouts',
+            'timeouts.type DERIVE',
+            'timeouts.min 0',
+            'multigraph %s_bytes' % STATS_PLUGIN,
+            'graph_title pypmmn traffic',
+            'graph_vlabel bytes per ${graph_period}',
+            'graph_category munin',
+            'graph_args --base 1024 -l 0',
+            'sent.label sent',
+            'sent.type DERIVE',
+            'sent.min 0',
+            'multigraph %s_sessions' % STATS_PLUGIN,
+            'graph_title pypmmn sessions',
+            'graph_vlabel sessions',
+            'graph_category munin',
+            'graph_args --base 1000 -l 0',
+            'active.label active sessions',
+            ])
+        return '\n'.join(lines) + '\n'
+
+    def munin_fetch(self):
+        """
+        Returns the ``fetch`` output of the built-in stats plugin.
+        """
+        snapshot = self.published()
+        histograms = snapshot['histograms']
+        counters = snapshot['counters']
+        lines = []
+        for group in ('command', 'plugin'):
+            if not histograms.get(group):
+                continue
+            lines.append('multigraph %s_%s_time' % (STATS_PLUGIN, group))
+            for key, values in sorted(histograms.get(group, {}).items()):
+                lines.append('%s.value %.6f' % (field_name(key),
+                    values['p99']))
+        queue = histograms.get('queue', {}).get('executor',
+            Histogram().as_dict())
+        lines.extend([
+            'multigraph %s_queue' % STATS_PLUGIN,
+            'p50.value %.6f' % queue['p50'],
+            'p99.value %.6f' % queue['p99'],
+            'multigraph %s_activity' % STATS_PLUGIN,
+            'forks.value %d' % counters.get('forks', 0),
+            'sessions.value %d' % counters.get('sessions', 0),
+            'timeouts.value %d' % counters.get('timeouts', 0),
+            'multigraph %s_bytes' % STATS_PLUGIN,
+            'sent.value %d' % counters.get('bytes_sent', 0),
+            'multigraph %s_sessions' % STATS_PLUGIN,
+            'active.value %d' % snapshot['gauges'].get('active_sessions', 0),
+            ])
+        return '\n'.join(lines) + '\n'
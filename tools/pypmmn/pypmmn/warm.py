@@ -0,0 +1,313 @@
+"""
+Runs python plugins in long-lived, warm worker processes.
+
+Each worker is a fork server (see ``warm_worker.py``) running under the
+interpreter named in the plugin's shebang line. It saves the interpreter
+startup and the module imports on every plugin run. Workers are recycled
+after a number of runs or when they grow too large, and replaced when they
+die.
+"""
+from os.path import join, abspath, dirname, basename, getmtime
+from subprocess import Popen, PIPE
+from time import time
+import json
+import logging
+import os
+import signal
+import threading
+
+from runner import PluginTimeout, READ_SIZE, wait_readable
+
+LOG = logging.getLogger(__name__)
+
+WORKER_SCRIPT = join(abspath(dirname(__file__)), 'warm_worker.py')
+
+#: Recycle a worker after this many plugin runs
+MAX_CALLS = 1000
+#: Recycle a worker once its resident set grows beyond this many kB
+MAX_RSS_KB = 100 * 1024
+
+#: Seconds a worker gets beyond the plugin's deadline to kill the plugin and
+#: reply, before it is considered hung
+REPLY_GRACE = 2
+
+#: The largest reply header accepted from a worker (in bytes)
+MAX_HEADER = 64
+
+
+def python_interpreter(plugin_filename):
+    """
+    Returns the interpreter command of a python plugin as a list, or
+    ``None`` if ``plugin_filename`` is not a python script.
+    """
+    try:
+        fptr = open(plugin_filename, 'rb')
+        try:
+            first_line = fptr.readline(256)
+        finally:
+            fptr.close()
+    except IOError:
+        return None
+    if not first_line.startswith('#!'):
+        return None
+    command = first_line[2:].split()
+    if not command:
+        return None
+    interpreter = command[0]
+    if basename(interpreter) == 'env' and len(command) > 1:
+        interpreter = command[1]
+    if not basename(interpreter).startswith('python'):
+        return None
+    return command
+
+
+class WorkerError(OSError):
+    """
+    Raised when a worker dies or misbehaves during a plugin run.
+    """
+
+
+class PythonWorker(object):
+    """
+    One warm fork server process.
+
+    :param interpreter: The interpreter command as a list
+    """
+
+    def __init__(self, interpreter):
+        self.interpreter = interpreter
+        self.calls = 0
+        self.proc = Popen(interpreter + [WORKER_SCRIPT], stdin=PIPE,
+            stdout=PIPE, close_fds=True)
+        LOG.info('Started python worker %d (%s)', self.proc.pid,
+            ' '.join(interpreter))
+
+    def run(self, plugin_filename, args, env, timeout=0, credentials=None):
+        """
+        Runs a plugin and returns its output.
+
+        :param timeout: Deadline in seconds enforced by the worker. ``0``
+            disables it. A worker not replying within :py:data:`REPLY_GRACE`
+            seconds after the deadline is killed.
+        :param credentials: An optional ``(uid, gid, groups)`` tuple the
+            forked child switches to
+        :raises WorkerError: if the worker died
+        :raises PluginTimeout: if the plugin was killed by the worker, or the
+            worker was killed for missing the deadline
+        """
+        self.calls += 1
+        request = {
+            'path': plugin_filename,
+            'args': args,
+            'env': env,
+            'timeout': timeout,
+            }
+        if credentials is not None:
+            request['uid'], request['gid'], request['groups'] = credentials
+        request = json.dumps(request)
+        deadline = None
+        if timeout:
+            deadline = time() + timeout + REPLY_GRACE
+        try:
+            self.proc.stdin.write(request + '\n')
+            self.proc.stdin.flush()
+            reply = ''
+            while '\n' not in reply:
+                if len(reply) > MAX_HEADER:
+                    raise ValueError('Invalid reply header %r' % reply)
+                reply += self._read(deadline, plugin_filename, timeout)
+            header, output = reply.split('\n', 1)
+            code, length, timed_out = [int(_) for _ in header.split()]
+            while len(output) < length:
+                output += self._read(deadline, plugin_filename, timeout)
+        except (PluginTimeout, WorkerError):
+            raise
+        except (IOError, OSError, ValueError), exc:
+            raise WorkerError('Python worker %d failed: %s' % (
+                self.proc.pid, exc))
+        if len(output) != length:
+            raise WorkerError('Python worker %d sent more than announced' %
+                self.proc.pid)
+        if timed_out:
+            raise PluginTimeout(basename(plugin_filename), timeout)
+        if code != 0:
+            LOG.debug('%s exited with code %d', plugin_filename, code)
+        return output
+
+    def _read(self, deadline, plugin_filename, timeout):
+        """
+        Reads the next part of a reply. Reading from the descriptor instead
+        of the buffered file object keeps ``wait_readable`` reliable.
+
+        :raises PluginTimeout: if ``deadline`` passed. The worker is killed.
+        :raises WorkerError: if the worker died
+        """
+        fd = self.proc.stdout.fileno()
+        while deadline is not None and not wait_readable(fd,
+                max(deadline - time(), 0)):
+            if time() >= deadline:
+                LOG.warning('Python worker %d did not reply in time. '
+                    'Killing it.', self.proc.pid)
+                self.kill()
+                raise PluginTimeout(basename(plugin_filename), timeout)
+        data = os.read(fd, READ_SIZE)
+        if not data:
+            raise WorkerError('Python worker %d died' % self.proc.pid)
+        return data
+
+    def kill(self):
+        """
+        Kills a hung worker. The pool replaces it, as it is no longer
+        running.
+        """
+        try:
+            os.kill(self.proc.pid, signal.SIGKILL)
+        except OSError:
+            pass
+        self.proc.wait()
+
+    def rss(self):
+        """
+        Returns the resident set size in kB, or ``None`` if unknown.
+        """
+        try:
+            fptr = open('/proc/%d/status' % self.proc.pid)
+            try:
+                for line in fptr:
+                    if line.startswith('VmRSS:'):
+                        return int(line.split()[1])
+            finally:
+                fptr.close()
+        except (IOError, ValueError):
+            pass
+        return None
+
+    def is_worn_out(self, max_calls, max_rss):
+        """
+        Returns ``True`` if the worker should be replaced.
+        """
+        if self.proc.poll() is not None:
+            return True
+        if self.calls >= max_calls:
+            return True
+        rss = self.rss()
+        return rss is not None and rss > max_rss
+
+    def close(self):
+        """
+        Stops the worker.
+        """
+        try:
+            self.proc.stdin.close()
+        except IOError:
+            pass
+        if self.proc.poll() is None:
+            try:
+                os.kill(self.proc.pid, signal.SIGTERM)
+            except OSError:
+                pass
+        self.proc.wait()
+
+
+class WarmPythonPool(object):
+    """
+    Hands out idle :py:class:`PythonWorker` instances per interpreter,
+    starting new ones on demand.
+
+    :param max_calls: Recycle workers after this many plugin runs
+    :param max_rss: Recycle workers larger than this many kB
+    """
+
+    def __init__(self, max_calls=MAX_CALLS, max_rss=MAX_RSS_KB):
+        self.max_calls = max_calls
+        self.max_rss = max_rss
+        self.restarts = 0
+        self._idle = {}
+        self._interpreters = {}
+        self._lock = threading.Lock()
+
+    def interpreter(self, plugin_filename):
+        """
+        Returns the python interpreter command of a plugin, or ``None`` if
+        it is not a python plugin. Results are cached until the file changes.
+        """
+        try:
+            mtime = getmtime(plugin_filename)
+        except OSError:
+            return None
+        cached = self._interpreters.get(plugin_filename)
+        if cached and cached[0] == mtime:
+            return cached[1]
+        interpreter = python_interpreter(plugin_filename)
+        self._interpreters[plugin_filename] = (mtime, interpreter)
+        return interpreter
+
+    def _acquire(self, interpreter):
+        key = tuple(interpreter)
+        self._lock.acquire()
+        try:
+            idle = self._idle.get(key)
+            if idle:
+                return idle.pop()
+        finally:
+            self._lock.release()
+        return PythonWorker(interpreter)
+
+    def _release(self, worker):
+        if worker.is_worn_out(self.max_calls, self.max_rss):
+            LOG.info('Recycling python worker %d after %d runs',
+                worker.proc.pid, worker.calls)
+            worker.close()
+            return
+        self._lock.acquire()
+        try:
+            self._idle.setdefault(tuple(worker.interpreter), []).append(
+                worker)
+        finally:
+            self._lock.release()
+
+    def run(self, plugin_filename, interpreter, args, env=None, timeout=0,
+            credentials=None):
+        """
+        Runs a python plugin in a warm worker and returns its output. A
+        worker that dies during the run is replaced and the run is retried
+        once.
+
+        :param env: The environment of the plugin. Defaults to ours.
+        :param timeout: Deadline in seconds. ``0`` disables it.
+        :param credentials: An optional ``(uid, gid, groups)`` tuple to run
+            the plugin with
+        :raises PluginTimeout: if the plugin did not finish in time
+        """
+        if env is None:
+            env = dict(os.environ)
+        for attempt in (1, 2):
+            worker = self._acquire(interpreter)
+            try:
+                output = worker.run(plugin_filename, args, env, timeout,
+                    credentials)
+            except PluginTimeout:
+                self._release(worker)
+                raise
+            except WorkerError, exc:
+                LOG.warning('%s. Restarting it.', exc)
+                worker.close()
+                self.restarts += 1
+                if attempt == 2:
+                    raise
+                continue
+            self._release(worker)
+            return output
+
+    def close(self):
+        """
+        Stops all idle workers.
+        """
+        self._lock.acquire()
+        try:
+            for workers in self._idle.values():
+                for worker in workers:
+                    worker.close()
+            self._idle.clear()
+        finally:
+            self._lock.release()
@@ -0,0 +1,259 @@
+#!/usr/bin/env python
+"""
+A warm fork server for python plugins. It is started by pypmmn (see
+``warm.py``) using the plugin's own interpreter and is not meant to be run by
+hand.
+
+Requests are read from stdin, one JSON object per line::
+
+    {"path": "/path/to/plugin", "args": ["config"], "env": {...},
+     "timeout": 10, "uid": 65534, "gid": 65534, "groups": [65534]}
+
+Each plugin run happens in a forked child with its own ``argv``, environment
+and stdout, so runs cannot influence each other. The parent stays alive
+between runs and imports the standard library modules the plugins used, so
+later runs start with a warm interpreter. Other modules are never imported
+into the parent: their top level code could start threads or open sockets,
+which every later child would inherit. An optional ``timeout`` (in seconds)
+kills the child's process group once it expires. The optional ``uid``,
+``gid`` and ``groups`` are set in the child before the plugin runs. The
+reply to each request is a header line ``<exit code> <length> <timed out>``
+followed by ``length`` bytes of plugin output.
+
+As this runs under whatever python version the plugins use, it must stay
+compatible with both python 2 and python 3.
+"""
+import json
+import os
+import select
+import signal
+import sys
+import time
+import traceback
+
+try:
+    import runpy
+    # imported lazily by runpy, which fails once a child dropped its
+    # privileges if the standard library is not readable by that user
+    __import__('pkgutil')
+except ImportError:
+    runpy = None
+
+#: Maximum size of the module list reported by a child (in bytes)
+MAX_MODULE_LIST = 32 * 1024
+
+
+def standard_library_dirs():
+    """
+    Returns the folders of the standard library of this interpreter.
+    """
+    try:
+        import sysconfig
+        paths = sysconfig.get_paths()
+        dirs = [paths['stdlib'], paths['platstdlib']]
+    except ImportError:
+        from distutils import sysconfig
+        dirs = [sysconfig.get_python_lib(standard_lib=True),
+            sysconfig.get_python_lib(standard_lib=True, plat_specific=True)]
+    return [os.path.realpath(folder) + os.sep for folder in dirs]
+
+STANDARD_LIBRARY_DIRS = standard_library_dirs()
+
+
+def is_standard_library(module):
+    """
+    Returns ``True`` if ``module`` is built in or part of the standard
+    library, and not installed into it by a third party.
+    """
+    filename = getattr(module, '__file__', None)
+    if filename is None:
+        return module is not None
+    filename = os.path.realpath(filename)
+    if 'site-packages' in filename or 'dist-packages' in filename:
+        return False
+    for folder in STANDARD_LIBRARY_DIRS:
+        if filename.startswith(folder):
+            return True
+    return False
+
+
+def native(value):
+    """
+    The JSON decoder of python 2 returns unicode strings, while plugins
+    expect ``str`` in ``argv`` and the environment.
+    """
+    if sys.version_info[0] < 3 and not isinstance(value, str):
+        return value.encode('utf-8')
+    return value
+
+
+def switch_credentials(request):
+    """
+    Drops the privileges of the (child) process as requested.
+    """
+    if request.get('groups') is not None:
+        os.setgroups(request['groups'])
+    if request.get('gid') is not None:
+        os.setgid(request['gid'])
+    if request.get('uid') is not None:
+        os.setuid(request['uid'])
+
+
+def run_plugin(path, args, env):
+    """
+    Executes the plugin in the current (child) process and returns the exit
+    code.
+    """
+    path = native(path)
+    sys.argv = [path] + [native(arg) for arg in args]
+    os.environ.clear()
+    for key, value in env.items():
+        os.environ[native(key)] = native(value)
+    sys.path[0] = os.path.dirname(path)
+    try:
+        if runpy is not None and hasattr(runpy, 'run_path'):
+            runpy.run_path(path, run_name='__main__')
+        else:
+            source = open(path).read()
+            code = compile(source, path, 'exec')
+            namespace = {'__name__': '__main__', '__file__': path}
+            exec(code, namespace)
+        return 0
+    except SystemExit:
+        code = sys.exc_info()[1].code
+        if code is None:
+            return 0
+        if isinstance(code, int):
+            return code
+        sys.stderr.write('%s\n' % code)
+        return 1
+    except BaseException:
+        traceback.print_exc()
+        return 1
+
+
+def read_until(fd, deadline):
+    """
+    Reads ``fd`` until EOF. Returns the data and ``False``, or the data read
+    so far and ``True`` if ``deadline`` passed first. A deadline of ``None``
+    waits forever.
+    """
+    chunks = []
+    while True:
+        if deadline is not None:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                return b''.join(chunks), True
+            try:
+                if not select.select([fd], [], [], remaining)[0]:
+                    continue
+            except select.error:
+                continue
+        data = os.read(fd, 65536)
+        if not data:
+            return b''.join(chunks), False
+        chunks.append(data)
+
+
+def fork_and_run(request):
+    """
+    Runs one request in a forked child. Returns the exit code, the captured
+    output, whether the child timed out and the names of modules the child
+    imported.
+    """
+    deadline = None
+    if request.get('timeout'):
+        deadline = time.time() + request['timeout']
+    out_r, out_w = os.pipe()
+    mod_r, mod_w = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.setsid()
+        os.close(out_r)
+        os.close(mod_r)
+        devnull = os.open(os.devnull, os.O_RDONLY)
+        os.dup2(devnull, 0)
+        os.dup2(out_w, 1)
+        sys.stdout = os.fdopen(1, 'w')
+        before = set(sys.modules)
+        code = 1
+        try:
+            try:
+                switch_credentials(request)
+            except OSError:
+                traceback.print_exc()
+                os._exit(1)
+            code = run_plugin(request['path'], request.get('args', []),
+                request.get('env', {}))
+            sys.stdout.flush()
+            new_modules = '\n'.join(sorted(name
+                for name in set(sys.modules) - before
+                if is_standard_library(sys.modules[name])))
+            # stay below the pipe buffer size, the parent reads this last
+            os.write(mod_w, new_modules.encode('utf-8')[:MAX_MODULE_LIST])
+        finally:
+            os._exit(code)
+
+    os.close(out_w)
+    os.close(mod_w)
+    output, timed_out = read_until(out_r, deadline)
+    modules = b''
+    if not timed_out:
+        modules, timed_out = read_until(mod_r, deadline)
+    if timed_out:
+        try:
+            os.killpg(pid, signal.SIGKILL)
+        except OSError:
+            pass
+    os.close(out_r)
+    os.close(mod_r)
+    status = os.waitpid(pid, 0)[1]
+    if os.WIFEXITED(status):
+        code = os.WEXITSTATUS(status)
+    else:
+        code = -os.WTERMSIG(status)
+    if timed_out:
+        return code, b'', True, []
+    modules = modules.decode('utf-8').split('\n')
+    return code, output, False, [name for name in modules if name]
+
+
+def warm_up(modules):
+    """
+    Imports the standard library modules used by a plugin into this
+    process, so forked children do not need to import them again. The
+    children only report those. Failures are ignored.
+    """
+    for name in modules:
+        if name in sys.modules:
+            continue
+        try:
+            __import__(name)
+        except BaseException:
+            pass
+
+
+def main():
+    if hasattr(sys.stdin, 'buffer'):
+        stdin = sys.stdin.buffer
+    else:
+        stdin = sys.stdin
+    # Keep the protocol channel away from fd 1, so nothing printed while
+    # warming up modules can corrupt it.
+    stdout = os.fdopen(os.dup(1), 'wb')
+    os.dup2(os.open(os.devnull, os.O_WRONLY), 1)
+    while True:
+        line = stdin.readline()
+        if not line:
+            break
+        request = json.loads(line.decode('utf-8'))
+        code, output, timed_out, modules = fork_and_run(request)
+        stdout.write(('%d %d %d\n' % (code, len(output), timed_out)).encode(
+            'ascii'))
+        stdout.write(output)
+        stdout.flush()
+        warm_up(modules)
+
+
+if __name__ == '__main__':
+    main()